@@ -13,6 +13,8 @@ typedef struct {
 } Command; 
 
 bool GetNextReportFromCommands(const Command* const commands, int step_size, USB_JoystickReport_Input_t* const ReportData);
+bool GetNextReportFromRamCommands(const Command* const commands, int step_size, USB_JoystickReport_Input_t* const ReportData);
+bool GetNextReportFromSequence(const Command* const commands, int step_size, USB_JoystickReport_Input_t* const ReportData, bool in_ram, int ratio);
 
 // The commands that run independently from a PC
 // Store arrays in Flash memory to save a SRAM data capacity
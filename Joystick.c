@@ -19,9 +19,78 @@ these buttons for our use.
 */
 
 #include <LUFA/Drivers/Peripheral/Serial.h>
+#include <util/atomic.h>
 #include "Commands.h"
 
+// The firmware always starts at this rate. A higher rate is negotiated with "end baud <rate>".
+#define BASE_BAUD_RATE 9600
+#define MAX_BAUD_RATE 1000000
+// Time (ms) to wait for the confirmation at a new rate before falling back (BAUD_CONFIRM_TIMEOUT in Sender.py)
+#define BAUD_CONFIRM_TIMEOUT_MS 1000
+// Framing errors without a valid line in between that mean PC is sending at another rate
+#define BAUD_ERROR_LIMIT 4
+
 USB_JoystickReport_Input_t pc_report;
+// the report that is repeated while a step of a sequence lasts
+USB_JoystickReport_Input_t last_report;
+uint32_t cur_baud_rate = BASE_BAUD_RATE;
+bool baud_confirming = false;
+volatile uint16_t baud_confirm_ms = 0;
+
+// Received bytes are only buffered in the ISR and parsed in the main loop
+#define RX_BUFFER_SIZE 64
+volatile uint8_t rx_buffer[RX_BUFFER_SIZE];
+volatile uint8_t rx_head = 0; // written by the ISR
+volatile uint8_t rx_tail = 0; // written by the main loop
+volatile uint8_t rx_errors = 0;
+
+// Echoed bytes wait here while the UART is busy, so that a burst of rows is echoed without gaps
+#define ECHO_BUFFER_SIZE 32
+uint8_t echo_buffer[ECHO_BUFFER_SIZE];
+uint8_t echo_head = 0;
+uint8_t echo_tail = 0;
+
+void SetBaudRate(uint32_t baud_rate)
+{
+	// double speed mode keeps the error small at high rates
+	Serial_Init(baud_rate, baud_rate > BASE_BAUD_RATE);
+	// Serial_Init() clears the receive interrupt flag
+	UCSR1B |= (1 << RXCIE1);
+	cur_baud_rate = baud_rate;
+	rx_errors = 0;
+}
+
+// Fall back to the base rate if PC did not confirm a new rate, or is sending at another rate
+// (e.g. it was restarted and opened the port at the base rate). This runs even while USB is not configured.
+void CheckBaudRate(void)
+{
+	bool fallback = false;
+	ATOMIC_BLOCK(ATOMIC_RESTORESTATE)
+	{
+		if (baud_confirming && baud_confirm_ms == 0)
+			fallback = true;
+		if (rx_errors >= BAUD_ERROR_LIMIT)
+		{
+			rx_errors = 0;
+			fallback |= cur_baud_rate != BASE_BAUD_RATE;
+		}
+	}
+	if (fallback)
+	{
+		baud_confirming = false;
+		SetBaudRate(BASE_BAUD_RATE);
+		// drop what was received at the wrong rate
+		rx_tail = rx_head;
+		ResetSerialBuffer();
+	}
+}
+
+// Timer0 ticks every 1 ms
+ISR(TIMER0_COMPA_vect)
+{
+	if (baud_confirm_ms > 0)
+		baud_confirm_ms--;
+}
 
 void ResetDirections()
 {
@@ -34,7 +103,7 @@ void ResetDirections()
 
 // Main entry point.
 int main(void) {
-	Serial_Init(9600, false);
+	Serial_Init(BASE_BAUD_RATE, false);
 	Serial_CreateStream(NULL);
 
 	sei();
@@ -49,6 +118,9 @@ int main(void) {
 	// Once that's done, we'll enter an infinite loop.
 	for (;;)
 	{
+		// We parse the rows received from PC.
+		ProcessSerial();
+		CheckBaudRate();
 		// We need to run our task to process and deliver data for our IN and OUT endpoints.
 		HID_Task();
 		// We also need to run the main USB management task.
@@ -76,6 +148,11 @@ PORTD will toggle when printing is done.
 	DDRB  = 0xFF; //uses PORTB. Micro can use either or, but both give us 2 LEDs
 	PORTB =  0x0; //The ATmega328P on the UNO will be resetting, so unplug it?
 	#endif
+	// Timer0 in CTC mode for a 1 ms tick (F_CPU / 64 / 1000)
+	TCCR0A = (1 << WGM01);
+	TCCR0B = (1 << CS01) | (1 << CS00);
+	OCR0A = F_CPU / 64 / 1000 - 1;
+	TIMSK0 = (1 << OCIE0A);
 	// The USB stack should be initialized last.
 	USB_Init();
 }
@@ -213,6 +290,7 @@ typedef enum {
 
 	// From PC
 	PC_CALL,
+	RAM_MACRO,	// run a sequence uploaded from PC
 } Proc_State_t;
 Proc_State_t proc_state = NONE;
 
@@ -233,9 +311,120 @@ int duration_buf;
 int step_size_buf;
 
 uint8_t pc_lx, pc_ly, pc_rx, pc_ry;
+
+// Sequence uploaded from PC.
+// "end macro <size>" starts an upload, "mstep <button> <duration> ..." (hex, up to 3 steps per line) adds steps
+// and "mrun <repeat>" runs it (0 repeats forever). The duration is counted in reports.
+#define MACRO_MAX_STEPS 24
+Command macro_commands[MACRO_MAX_STEPS];
+uint8_t macro_size = 0;
+uint8_t macro_expected = 0;
+uint16_t macro_repeat = 0;
+
+// "hold <reports> <line>" applies the line for the given number of reports (hex, REPORT_INTERVAL_MS each)
+// and then restores the report before the hold
+USB_JoystickReport_Input_t hold_restore;
+volatile uint16_t hold_count = 0;
+
+// Binary frame: [SYNC] [btn_hi] [btn_lo] [hat] [v0] [v1] [v2] [v3] [checksum]
+// v0-v3 are the same as the stick values of a text line, checksum is XOR of btn_hi to v3.
+// Enabled with "end binary" ("end ascii" to disable). Text lines are still accepted outside frames.
+#define BIN_SYNC 0xA5
+#define BIN_FRAME_SIZE 8
+bool is_binary_mode = false;
+bool in_bin_frame = false;
+// after a broken frame, bytes are dropped until the next SYNC or the end of a line
+bool bin_resync = false;
+uint8_t bin_frame[BIN_FRAME_SIZE];
+uint8_t bin_idx = 0;
 uint32_t YearChangeCnt;//0~4294967295回まで可
 int NowYear = 0;
 
+void ApplyPcReport(uint16_t p_btns, uint8_t hat, uint8_t lx, uint8_t ly, uint8_t rx, uint8_t ry)
+{
+	// a new report cancels the hold
+	hold_count = 0;
+	memset(&pc_report, 0, sizeof(uint16_t));
+
+	// HAT : 0(TOP) to 7(TOP_LEFT) in clockwise | 8(CENTER)
+	pc_report.HAT = hat;
+
+	// we use bit array for buttons(2 Bytes), which last 2 bits are flags of directions
+	bool use_right = p_btns & 0x1;
+	bool use_left = p_btns & 0x2;
+
+	// Left stick
+	if (use_left) {
+		pc_report.LX = lx;
+		pc_report.LY = ly;
+	}
+
+	// Right stick
+	if (use_right & use_left) {
+		pc_report.RX = rx;
+		pc_report.RY = ry;
+	} else if (use_right) {
+		pc_report.RX = lx;
+		pc_report.RY = ly;
+	}
+
+	p_btns >>= 2;
+	pc_report.Button |= p_btns;
+
+	proc_state = PC_CALL;
+}
+
+// return: the checksum is correct?
+bool ParseBinaryFrame(const uint8_t* frame)
+{
+	uint8_t checksum = 0;
+	for (uint8_t i = 0; i < BIN_FRAME_SIZE - 1; i++)
+		checksum ^= frame[i];
+
+	// drop broken frames
+	if (checksum != frame[BIN_FRAME_SIZE - 1])
+		return false;
+
+	ApplyPcReport(((uint16_t)frame[0] << 8) | frame[1], frame[2], frame[3], frame[4], frame[5], frame[6]);
+
+	step_index = 0;
+	step_size_buf = INT8_MAX;
+	duration_buf = 0;
+	return true;
+}
+
+void ResetSerialBuffer(void)
+{
+	idx = 0;
+	memset(pc_report_str, 0, sizeof(pc_report_str));
+	in_bin_frame = false;
+	bin_resync = false;
+	bin_idx = 0;
+}
+
+// A byte was lost or corrupted: the broken frame may already contain the SYNC of the next frame.
+// Restart from the first SYNC in it, or drop bytes until the next SYNC so that the rest is not parsed as text.
+void ResyncBinaryFrame(void)
+{
+	idx = 0;
+	memset(pc_report_str, 0, sizeof(pc_report_str));
+
+	for (uint8_t i = 0; i < BIN_FRAME_SIZE; i++)
+	{
+		if (bin_frame[i] == BIN_SYNC)
+		{
+			bin_idx = BIN_FRAME_SIZE - 1 - i;
+			memmove(bin_frame, bin_frame + i + 1, bin_idx);
+			in_bin_frame = true;
+			bin_resync = false;
+			return;
+		}
+	}
+	in_bin_frame = false;
+	bin_idx = 0;
+	bin_resync = true;
+}
+
 void ParseLine(char* line)
 {
 	char cmd[16];
@@ -248,11 +437,54 @@ void ParseLine(char* line)
 	if (ret == EOF) {
 		proc_state = DEBUG;
 	} else if (strncmp(cmd, "end", 16) == 0) {
+		char arg[16];
 		proc_state = NONE;
+		hold_count = 0;
 		ResetDirections();
-	} else if (cmd[0] >= '0' && cmd[0] <= '9') {
-		memset(&pc_report, 0, sizeof(uint16_t));
 
+		// options are given as "end <option>" so that old firmwares only reset on them
+		if (sscanf(line, "%*s %15s", arg) == 1) {
+			if (strncmp(arg, "binary", 16) == 0) {
+				is_binary_mode = true;
+				printf("OK BIN\r\n");
+			} else if (strncmp(arg, "ascii", 16) == 0) {
+				is_binary_mode = false;
+				printf("OK ASCII\r\n");
+			} else if (strncmp(arg, "hold", 16) == 0) {
+				printf("OK HOLD\r\n");
+			} else if (strncmp(arg, "macro", 16) == 0) {
+				unsigned int size;
+				if (sscanf(line, "%*s %*s %u", &size) == 1 && size > 0 && size <= MACRO_MAX_STEPS) {
+					macro_size = 0;
+					macro_expected = size;
+					printf("OK MACRO %u\r\n", size);
+				} else {
+					printf("NG MACRO\r\n");
+				}
+			} else if (strncmp(arg, "baud", 16) == 0) {
+				uint32_t baud_rate;
+				if (sscanf(line, "%*s %*s %lu", &baud_rate) == 1
+						&& baud_rate >= BASE_BAUD_RATE && baud_rate <= MAX_BAUD_RATE) {
+					// answer at the current rate, then switch after the answer has been sent
+					UCSR1A |= (1 << TXC1);
+					printf("OK BAUD %lu\r\n", baud_rate);
+					if (baud_rate != cur_baud_rate) {
+						while (!Serial_IsSendComplete());
+						SetBaudRate(baud_rate);
+						// PC confirms the link by sending the same command at the new rate
+						// (no confirmation is needed when going back to the base rate)
+						ATOMIC_BLOCK(ATOMIC_RESTORESTATE)
+						{
+							baud_confirm_ms = BAUD_CONFIRM_TIMEOUT_MS;
+						}
+						baud_confirming = baud_rate != BASE_BAUD_RATE;
+					} else {
+						baud_confirming = false;
+					}
+				}
+			}
+		}
+	} else if (cmd[0] >= '0' && cmd[0] <= '9') {
 		// format [button LeftStickX LeftStickY RightStickX RightStickY HAT] 
 		// button: Y | B | A | X | L | R | ZL | ZR | MINUS | PLUS | LCLICK | RCLICK | HOME | CAP
 		// LeftStick : 0 to 255
@@ -260,32 +492,7 @@ void ParseLine(char* line)
 		sscanf(line, "%hx %hhx %hhx %hhx %hhx %hhx", &p_btns, &hat,
 				&pc_lx, &pc_ly, &pc_rx, &pc_ry);
 
-		// HAT : 0(TOP) to 7(TOP_LEFT) in clockwise | 8(CENTER)
-		pc_report.HAT = hat;
-
-		// we use bit array for buttons(2 Bytes), which last 2 bits are flags of directions
-		bool use_right = p_btns & 0x1;
-		bool use_left = p_btns & 0x2;
-
-		// Left stick
-		if (use_left) {
-			pc_report.LX = pc_lx;
-			pc_report.LY = pc_ly;
-		}
-
-		// Right stick
-		if (use_right & use_left) {
-			pc_report.RX = pc_rx;
-			pc_report.RY = pc_ry;
-		} else if (use_right) {
-			pc_report.RX = pc_lx;
-			pc_report.RY = pc_ly;
-		}
-
-		p_btns >>= 2;
-		pc_report.Button |= p_btns;
-
-		proc_state = PC_CALL;
+		ApplyPcReport(p_btns, hat, pc_lx, pc_ly, pc_rx, pc_ry);
 	} else if (strncmp(cmd, cmd_name[0], 16) == 0) {
 		proc_state = MASH_A;
 	} else if (strncmp(cmd, cmd_name[1], 16) == 0) {
@@ -298,6 +505,57 @@ void ParseLine(char* line)
 		proc_state = P_UNSYNC;
 	} else if (strncmp(cmd, cmd_name[5], 16) == 0) {
 		proc_state = PICKUPBERRY;
+	} else if (strncmp(cmd, "hold", 16) == 0) {
+		unsigned int reports;
+		int offset = 0;
+		if (sscanf(line, "%*s %x %n", &reports, &offset) == 1 && offset > 0 && reports > 0) {
+			// A hold that arrives while another hold is counting down keeps its restore target.
+			// Otherwise the report of the earlier hold would stay pressed after this one ends.
+			if (hold_count == 0) {
+				if (proc_state != PC_CALL) {
+					ResetDirections();
+					pc_report.Button = 0;
+				}
+				memcpy(&hold_restore, &pc_report, sizeof(USB_JoystickReport_Input_t));
+			}
+
+			sscanf(line + offset, "%hx %hhx %hhx %hhx %hhx %hhx", &p_btns, &hat,
+					&pc_lx, &pc_ly, &pc_rx, &pc_ry);
+			ApplyPcReport(p_btns, hat, pc_lx, pc_ly, pc_rx, pc_ry);
+			hold_count = reports;
+		}
+	} else if (strncmp(cmd, "mstep", 16) == 0) {
+		unsigned int v[6];
+		int n = sscanf(line, "%*s %x %x %x %x %x %x", &v[0], &v[1], &v[2], &v[3], &v[4], &v[5]);
+		bool added = false;
+		for (int i = 0; i + 1 < n && macro_size < macro_expected; i += 2) {
+			macro_commands[macro_size].button = (Buttons_t)v[i];
+			// duration_buf is a 16-bit int, so a longer step would wrap negative and end immediately
+			macro_commands[macro_size].duration = v[i + 1] > INT16_MAX ? INT16_MAX : v[i + 1];
+			macro_size++;
+			added = true;
+		}
+		if (added && macro_size == macro_expected)
+			printf("OK LOADED %u\r\n", macro_size);
+	} else if (strncmp(cmd, "mrun", 16) == 0) {
+		unsigned int repeat = 0;
+		sscanf(line, "%*s %u", &repeat);
+		if (macro_size > 0 && macro_size == macro_expected) {
+			macro_repeat = repeat;
+			duration_count = 0;
+			// start from the first step with a neutral report, not where the previous sequence stopped
+			step_index = 0;
+			duration_buf = 0;
+			step_size_buf = macro_size;
+			memset(&last_report, 0, sizeof(USB_JoystickReport_Input_t));
+			last_report.LX = STICK_CENTER;
+			last_report.LY = STICK_CENTER;
+			last_report.RX = STICK_CENTER;
+			last_report.RY = STICK_CENTER;
+			last_report.HAT = HAT_CENTER;
+			proc_state = RAM_MACRO;
+			return;
+		}
 	} else if (strncmp(cmd, "Year", 4) == 0) {
 		proc_state = CHANGETHEYEAR;
 		sscanf(line, "Year %lu",&YearChangeCnt);
@@ -312,14 +570,113 @@ void ParseLine(char* line)
 }
 
 ISR(USART1_RX_vect) 
+{
+	// the error flag has to be read before the data
+	bool is_framing_error = UCSR1A & (1 << FE1);
+	uint8_t c = UDR1;
+	if (is_framing_error)
+	{
+		if (rx_errors < UINT8_MAX)
+			rx_errors++;
+		return;
+	}
+
+	uint8_t next = (rx_head + 1) % RX_BUFFER_SIZE;
+	if (next != rx_tail)
+	{
+		rx_buffer[rx_head] = c;
+		rx_head = next;
+	}
+}
+
+// Parse the bytes received so far. Parsing (sscanf, printf) is too slow for the ISR at high baud rates.
+void ProcessSerial(void)
+{
+	// bytes that arrive meanwhile are left for the next loop so that USB is not starved
+	uint8_t head = rx_head;
+	while (rx_tail != head)
+	{
+		char c = rx_buffer[rx_tail];
+		rx_tail = (rx_tail + 1) % RX_BUFFER_SIZE;
+		ReceiveChar(c);
+	}
+	SendEcho(false);
+}
+
+// Send the echoed bytes that the UART can take now (all of them if wait is true)
+void SendEcho(bool wait)
+{
+	while (echo_tail != echo_head)
+	{
+		if (!Serial_IsSendReady())
+		{
+			if (!wait)
+				return;
+			continue;
+		}
+		Serial_SendByte(echo_buffer[echo_tail]);
+		echo_tail = (echo_tail + 1) % ECHO_BUFFER_SIZE;
+	}
+}
+
+void QueueEcho(char c)
+{
+	uint8_t next = (echo_head + 1) % ECHO_BUFFER_SIZE;
+	if (next == echo_tail)
+	{
+		// the echo is behind by a whole buffer (e.g. after a reply), wait for one byte to go out
+		while (!Serial_IsSendReady());
+		Serial_SendByte(echo_buffer[echo_tail]);
+		echo_tail = (echo_tail + 1) % ECHO_BUFFER_SIZE;
+	}
+	echo_buffer[echo_head] = c;
+	echo_head = next;
+}
+
+void ReceiveChar(char c)
 {
 	// one character comes at a time
-	char c = fgetc(stdin);
-	if (Serial_IsSendReady()) 
-		printf("%c", c);
+	QueueEcho(c);
+
+	if (in_bin_frame)
+	{
+		bin_frame[bin_idx++] = (uint8_t)c;
+		if (bin_idx == BIN_FRAME_SIZE)
+		{
+			if (ParseBinaryFrame(bin_frame))
+			{
+				in_bin_frame = false;
+				bin_idx = 0;
+				rx_errors = 0;
+			}
+			else
+			{
+				ResyncBinaryFrame();
+			}
+		}
+		return;
+	}
+	else if (is_binary_mode && (uint8_t)c == BIN_SYNC)
+	{
+		// start of a binary frame
+		in_bin_frame = true;
+		bin_resync = false;
+		bin_idx = 0;
+		return;
+	}
+	else if (bin_resync)
+	{
+		// a text line after the broken frame starts cleanly
+		if (c == '\r' || c == '\n')
+			bin_resync = false;
+		return;
+	}
 
 	if (c == '\r') 
 	{
+		rx_errors = 0;
+		// PC reads a reply as the text between the echoed '\r' and '\n'
+		SendEcho(true);
 		ParseLine(pc_report_str);
 		idx = 0;
 		memset(pc_report_str, 0, sizeof(pc_report_str));
@@ -329,7 +686,6 @@ ISR(USART1_RX_vect)
 }
 
 
-USB_JoystickReport_Input_t last_report;
 const int echo_ratio = 3; // for compatiblity
 bool is_use_sync = false;
 
@@ -410,6 +766,22 @@ void GetNextReport(USB_JoystickReport_Input_t* const ReportData) {
 				case PC_CALL:
 					// copy a report that was sent from PC
 					memcpy(ReportData, &pc_report, sizeof(USB_JoystickReport_Input_t));
+
+					// restore the report before "hold" when the given number of reports have been sent
+					ATOMIC_BLOCK(ATOMIC_RESTORESTATE)
+					{
+						if (hold_count > 0 && --hold_count == 0)
+							memcpy(&pc_report, &hold_restore, sizeof(USB_JoystickReport_Input_t));
+					}
+					break;
+
+				case RAM_MACRO:
+					if (!GetNextReportFromRamCommands(macro_commands, macro_size, ReportData)) {
+						if (macro_repeat > 0 && --macro_repeat == 0) {
+							proc_state = NONE;
+							printf("OK DONE\r\n");
+						}
+					}
 					break;
 
 				default:
@@ -438,10 +810,30 @@ bool GetNextReportFromCommands(
 	const Command* const commands, 
 	const int step_size, 
 	USB_JoystickReport_Input_t* const ReportData)
+{
+	return GetNextReportFromSequence(commands, step_size, ReportData, false, echo_ratio);
+}
+
+// Same as GetNextReportFromCommands() for commands in SRAM. The duration is counted in reports.
+bool GetNextReportFromRamCommands(
+	const Command* const commands, 
+	const int step_size, 
+	USB_JoystickReport_Input_t* const ReportData)
+{
+	return GetNextReportFromSequence(commands, step_size, ReportData, true, 1);
+}
+
+// return: commands have not reached to the end?
+bool GetNextReportFromSequence(
+	const Command* const commands, 
+	const int step_size, 
+	USB_JoystickReport_Input_t* const ReportData,
+	const bool in_ram,
+	const int ratio)
 {
 	// Repeat the last report at duration times
 	// duration_buf is mul by the ratio for concerning compatibility with code using echo variables
-	if (duration_count++ < duration_buf * echo_ratio)
+	if (duration_count++ < duration_buf * ratio)
 	{
 		memcpy(ReportData, &last_report, sizeof(USB_JoystickReport_Input_t));
 		return true;
@@ -466,8 +858,11 @@ bool GetNextReportFromCommands(
 		return false;
 	}
 
-	// Get command from flash memory
-	memcpy_P(&cur_command, &commands[step_index++], sizeof(Command));
+	// Get command from flash memory (or SRAM)
+	if (in_ram)
+		memcpy(&cur_command, &commands[step_index++], sizeof(Command));
+	else
+		memcpy_P(&cur_command, &commands[step_index++], sizeof(Command));
 	step_size_buf = step_size;
 
 	duration_buf = cur_command.duration;
@@ -85,6 +85,10 @@ typedef enum {
 #define STICK_CENTER 128
 #define STICK_MAX    255
 
+// Interval (ms) at which the Switch reads the input reports (125 Hz, whatever the descriptor asks for).
+// Durations counted in reports (hold, mstep) are based on this value; REPORT_INTERVAL in Macro.py needs to match it.
+#define REPORT_INTERVAL_MS 8
+
 #define YEAR_MAX 60
 
 // Joystick HID report structure. We have an input and an output.
@@ -152,4 +156,19 @@ void EVENT_USB_Device_ControlRequest(void);
 // Prepare the next report for the host.
 void GetNextReport(USB_JoystickReport_Input_t* const ReportData);
 void ApplyButtonCommand(Buttons_t button, USB_JoystickReport_Input_t* const ReportData);
+// Change the baud rate of the serial communication.
+void SetBaudRate(uint32_t baud_rate);
+// Apply a report sent from PC.
+void ApplyPcReport(uint16_t p_btns, uint8_t hat, uint8_t lx, uint8_t ly, uint8_t rx, uint8_t ry);
+bool ParseBinaryFrame(const uint8_t* frame);
+// Find the next binary frame after a broken one.
+void ResyncBinaryFrame(void);
+void ResetSerialBuffer(void);
+// Fall back to the base baud rate when the link at a higher rate is lost.
+void CheckBaudRate(void);
+// Parse the bytes buffered by the receive interrupt.
+void ProcessSerial(void);
+void SendEcho(bool wait);
+void QueueEcho(char c);
+void ReceiveChar(char c);
 #endif
@@ -4,6 +4,9 @@
 import cv2
 import datetime
 import os
+import sys
+import threading
+import time
 import numpy as np
 from logging import getLogger, DEBUG, NullHandler
 
@@ -30,6 +33,25 @@ def imwrite(filename, img, params=None):
 
 
 CAPTURE_DIR = "./Captures/"
+# コマンド・GUIが扱う座標の基準となる解像度。キャプチャ解像度が異なる場合はこの座標系から変換する
+BASE_RESOLUTION = (1280, 720)
+
+
+def scaleRect(rect, from_size, to_size):
+    """
+    解像度`from_size`の座標を解像度`to_size`の座標に変換する
+
+    Args:
+        rect (list): [x1, y1, x2, y2] または [x, y, w, h]
+        from_size (tuple): 変換前の解像度 (width, height)
+        to_size (tuple): 変換後の解像度 (width, height)
+    """
+    if tuple(from_size) == tuple(to_size):
+        return list(rect)
+    fx, fy = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    return [round(v * (fy if i % 2 else fx)) for i, v in enumerate(rect)]
+
+
 def _get_save_filespec(filename: str) -> str:
     """
     画像ファイルの保存パスを取得する。
@@ -48,13 +70,157 @@ def _get_save_filespec(filename: str) -> str:
         return os.path.join(CAPTURE_DIR, filename)
 
 
+class FramePool:
+    """
+    キャプチャに使う画像バッファを使い回すプール
+
+    外から参照されているバッファ(ビューを含む)は再利用しないので、フレームはコピーせずに保持してよい。
+
+    Args:
+        size (int): プールに持つバッファの最大数
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.allocated = 0
+        self.reused = 0
+        self.missed = 0
+        self._buffers = []
+        self._shape = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns:
+            np.ndarray: 誰も参照していないバッファ。空きがない場合やフレームの大きさがわからない場合はNone
+        """
+        with self._lock:
+            for buf in self._buffers:
+                # 参照はリスト、ループ変数、getrefcountの引数の3つだけ
+                if sys.getrefcount(buf) <= 3:
+                    self.reused += 1
+                    return buf
+            if self._shape is None:
+                return None
+            if len(self._buffers) >= self.size:
+                self.missed += 1
+                return None
+            buf = np.empty(self._shape, dtype=np.uint8)
+            self._buffers.append(buf)
+            self.allocated += 1
+            return buf
+
+    def adopt(self, image):
+        # OpenCVが確保した画像をプールに加える。フレームの大きさが変わった場合は作り直す
+        with self._lock:
+            if image.shape != self._shape or image.dtype != np.uint8:
+                self._buffers = []
+                self._shape = image.shape if image.dtype == np.uint8 else None
+            if self._shape is not None and len(self._buffers) < self.size:
+                self._buffers.append(image)
+                self.allocated += 1
+
+    def clear(self):
+        with self._lock:
+            self._buffers = []
+            self._shape = None
+
+    def stats(self):
+        return {'buffers': len(self._buffers), 'allocated': self.allocated, 'reused': self.reused, 'missed': self.missed}
+
+
+class Frame:
+    """
+    キャプチャした1枚のフレームと、そこから作った画像のキャッシュ
+
+    グレースケール・RGB・HSV・縮小画像は最初に要求されたときに一度だけ作り、同じフレームを使う
+    テンプレートマッチングやプレビューの間で共有する。共有するため、作った画像は書き込み不可にして返す。
+
+    Args:
+        image (np.ndarray): BGRのフレーム
+        frame_id (int): Cameraが付けたシーケンス番号
+        timestamp (float): 取得時刻(time.perf_counter)
+    """
+
+    def __init__(self, image, frame_id, timestamp):
+        self.image = image
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def size(self):
+        # (width, height)
+        return self.image.shape[1], self.image.shape[0]
+
+    def _get(self, key, make):
+        # 同じフレームに対して2回作らないよう、作る間もロックを持つ
+        with self._lock:
+            image = self._derived.get(key)
+            if image is None:
+                image = make()
+                image.flags.writeable = False
+                self._derived[key] = image
+            return image
+
+    def gray(self):
+        if self.image.ndim == 2:
+            return self.image
+        return self._get('gray', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+
+    def hsv(self):
+        return self._get('hsv', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV))
+
+    def resized(self, size, gray=False):
+        """
+        Args:
+            size (tuple): (width, height)
+        """
+        src = self.gray() if gray else self.image
+        if (src.shape[1], src.shape[0]) == tuple(size):
+            return src
+        return self._get(('resized', tuple(size), gray),
+                         lambda: cv2.resize(src, tuple(size), interpolation=cv2.INTER_AREA))
+
+    def scaled(self, factor, gray=False):
+        # 1/factorに縮小した画像(factor=2で半分、4で4分の1)
+        h, w = self.image.shape[:2]
+        return self.resized((w // factor, h // factor), gray)
+
+    def rgb(self, size=None):
+        # 表示用のRGB画像。sizeを指定すると縮小してから変換する
+        src = self.image if size is None else self.resized(size)
+        return self._get(('rgb', None if size is None else tuple(size)),
+                         lambda: cv2.cvtColor(src, cv2.COLOR_BGR2RGB))
+
+
 class Camera:
-    def __init__(self, fps=45):
+    def __init__(self, fps=45, use_capture_thread=False, frame_pool_size=4, capture_size=BASE_RESOLUTION):
         self.camera = None
-        self.capture_size = (1280, 720)
-        # self.capture_size = (1920, 1080)
+        # 640x360などに下げると、キャプチャとマッチングが軽くなる(テンプレートは解像度に合わせて拡大・縮小される)
+        self.capture_size = tuple(capture_size)
         self.capture_dir = "Captures"
         self.fps = int(fps)
+        self.image_bgr = None
+
+        # 専用スレッドでキャプチャし続け、最新フレームを共有するモード
+        self.use_capture_thread = use_capture_thread
+        self.frame_id = 0
+        self.frame_time = None
+        self._slots = [(None, 0, None), (None, 0, None)]  # (image, frame_id, timestamp)
+        self._front = 0
+        self._frame_lock = threading.Lock()
+        self._frame_cond = threading.Condition(self._frame_lock)
+        self._capture_thread = None
+        self._capture_stop = threading.Event()
+        # 表・裏のスロットと読み出し中の利用側が持つ分より多めに用意する
+        self.frame_pool = FramePool(frame_pool_size)
+        self._frame = None
 
         self._logger = getLogger(__name__)
         self._logger.addHandler(NullHandler())
@@ -84,6 +250,14 @@ class Camera:
         # self.camera.set(cv2.CAP_PROP_FPS, 60)
         self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.capture_size[0])
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.capture_size[1])
+        actual_size = (int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if actual_size != self.capture_size:
+            self._logger.warning(f"Capture size {self.capture_size} is not supported. Using {actual_size}")
+        else:
+            self._logger.debug(f"Capture size: {actual_size}")
+
+        if self.use_capture_thread:
+            self.startCaptureThread()
 
     # self.camera.set(cv2.CAP_PROP_SETTINGS, 0)
 
@@ -91,16 +265,134 @@ class Camera:
         self._logger.debug("Camera is opened")
         return self.camera.isOpened()
 
+    def isCaptureThreadRunning(self):
+        return self._capture_thread is not None and self._capture_thread.is_alive()
+
+    def startCaptureThread(self):
+        if self.isCaptureThreadRunning():
+            return
+        self._capture_stop.clear()
+        self._capture_thread = threading.Thread(target=self._captureLoop, name="CaptureThread", daemon=True)
+        self._capture_thread.start()
+        self._logger.debug("Capture thread started")
+
+    def stopCaptureThread(self):
+        if not self.isCaptureThreadRunning():
+            return
+        self._capture_stop.set()
+        with self._frame_cond:
+            self._frame_cond.notify_all()
+        self._capture_thread.join(timeout=2.0)
+        self._capture_thread = None
+        self._logger.debug("Capture thread stopped")
+
+    def _grab(self):
+        # プールのバッファに読み込む
+        buf = self.frame_pool.acquire()
+        if buf is None:
+            ret, image = self.camera.read()
+        else:
+            ret, image = self.camera.read(image=buf)
+        if not ret or image is None:
+            return False, None
+        if image is not buf:
+            self.frame_pool.adopt(image)
+        return ret, image
+
+    def _captureLoop(self):
+        is_failed = False
+        while not self._capture_stop.is_set():
+            ret, image = self._grab()
+            if not ret or image is None:
+                if not is_failed:
+                    self._logger.warning("Failed to grab a frame in the capture thread")
+                    is_failed = True
+                time.sleep(1.0 / max(self.fps, 1))
+                continue
+            is_failed = False
+            timestamp = time.perf_counter()
+
+            # 裏側のスロットに書き込んでから表と入れ替える
+            back = 1 - self._front
+            with self._frame_cond:
+                self.frame_id += 1
+                self._slots[back] = (image, self.frame_id, timestamp)
+                self._front = back
+                self.frame_time = timestamp
+                self.image_bgr = image
+                self._frame_cond.notify_all()
+
+    def readLatestFrame(self, timeout=1.0):
+        """
+        最新フレームとそのシーケンス番号・取得時刻を返す。
+
+        キャプチャスレッドが動いている場合はデバイスを読まずに共有スロットの内容を返す。
+        まだ1枚も取得できていない場合に限り、最大`timeout`秒だけ待つ。
+
+        Returns:
+            tuple: (image, frame_id, timestamp)
+        """
+        if not self.isCaptureThreadRunning():
+            _, self.image_bgr = self._grab()
+            with self._frame_lock:
+                self.frame_id += 1
+                self.frame_time = time.perf_counter()
+                return self.image_bgr, self.frame_id, self.frame_time
+
+        with self._frame_cond:
+            if self._slots[self._front][0] is None:
+                self._frame_cond.wait_for(lambda: self._slots[self._front][0] is not None
+                                          or self._capture_stop.is_set(), timeout)
+            return self._slots[self._front]
+
+    def waitNewFrame(self, last_frame_id, timeout=1.0):
+        """
+        `last_frame_id`より新しいフレームが届くまで待ち、`readLatestFrame`と同じ形式で返す。
+
+        キャプチャスレッドが動いていない場合は、読み込むたびに新しいフレームになるのでそのまま読み込む。
+        `timeout`秒以内に届かない場合は、その時点の最新フレームを返す。
+        """
+        if not self.isCaptureThreadRunning():
+            return self.readLatestFrame()
+
+        with self._frame_cond:
+            self._frame_cond.wait_for(lambda: self._slots[self._front][1] > last_frame_id
+                                      or self._capture_stop.is_set(), timeout)
+            return self._slots[self._front]
+
+    def getFrame(self, last_frame_id=None, timeout=1.0):
+        """
+        最新フレームをFrameとして返す。同じフレームには同じFrameを返すので、作った画像が共有される。
+
+        Args:
+            last_frame_id (int): 指定した場合は、これより新しいフレームが届くまで待つ(`waitNewFrame`と同じ)
+
+        Returns:
+            Frame: 読み込めなかった場合はNone
+        """
+        if last_frame_id is None:
+            image, frame_id, timestamp = self.readLatestFrame(timeout)
+        else:
+            image, frame_id, timestamp = self.waitNewFrame(last_frame_id, timeout)
+        if image is None:
+            return None
+        with self._frame_lock:
+            if self._frame is None or self._frame.frame_id != frame_id or self._frame.image is not image:
+                self._frame = Frame(image, frame_id, timestamp)
+            return self._frame
+
     def readFrame(self):
-        _, self.image_bgr = self.camera.read()
+        if self.isCaptureThreadRunning():
+            return self.readLatestFrame()[0]
+        _, self.image_bgr = self._grab()
         return self.image_bgr
 
     def saveCapture(self, filename=None, crop=None, crop_ax=None, img=None):
+        # crop_axはBASE_RESOLUTIONの座標で指定し、実際のフレームの解像度に合わせて変換する
         if crop_ax is None:
-            crop_ax = [0, 0, 1280, 720]
-        else:
-            pass
-            # print(crop_ax)
+            crop_ax = [0, 0, *BASE_RESOLUTION]
+        elif self.image_bgr is not None:
+            crop_ax = scaleRect(crop_ax, BASE_RESOLUTION, (self.image_bgr.shape[1], self.image_bgr.shape[0]))
 
         dt_now = datetime.datetime.now()
         if filename is None or filename == "":
@@ -136,11 +428,21 @@ class Camera:
             imwrite(save_path, image)
             self._logger.debug(f"Capture succeeded: {save_path}")
             print('capture succeeded: ' + save_path)
+            if self.image_bgr is not None and self.image_bgr.shape[1::-1] != BASE_RESOLUTION:
+                h, w = self.image_bgr.shape[:2]
+                self._logger.info(f"Captured at {w}x{h}. To use it as a template, "
+                                  f"add 'resolution = {w}, {h}' for it to Template/resolution.ini")
         except cv2.error as e:
             print("Capture Failed")
             self._logger.error(f"Capture Failed :{e}")
 
     def destroy(self):
+        self.stopCaptureThread()
+        with self._frame_lock:
+            self._slots = [(None, 0, None), (None, 0, None)]
+            self._frame = None
+        self._logger.debug(f"Frame pool: {self.frame_pool.stats()}")
+        self.frame_pool.clear()
         if self.camera is not None and self.camera.isOpened():
             self.camera.release()
             self.camera = None
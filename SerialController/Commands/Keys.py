@@ -5,9 +5,13 @@ import math
 import time
 from collections import OrderedDict
 from enum import Enum, IntEnum, IntFlag, auto
-import queue
 from logging import getLogger, DEBUG, NullHandler
 
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
 
 class Button(IntFlag):
     Y = auto()
@@ -59,85 +63,133 @@ min = 0
 center = 128
 max = 255
 
+# 0.1度刻みの角度のテーブル。スティック入力の行を作るたびに三角関数を計算しないようにする
+ANGLE_STEPS = 3600
+_COS = [math.cos(math.radians(i / 10)) for i in range(ANGLE_STEPS)]
+_SIN = [math.sin(math.radians(i / 10)) for i in range(ANGLE_STEPS)]
+_COS127 = [127.5 * c for c in _COS]
+_SIN127 = [127.5 * s for s in _SIN]
+# 0-255の値の16進表記(接頭辞なし)
+_HEX = [format(i, 'x') for i in range(256)]
+
+
+def _hex(value):
+    return _HEX[value] if 0 <= value <= 255 else format(value, 'x')
+
+
+def stickXY(angle, magnitude=1.0):
+    """
+    角度と倒す量から、送信するスティックの値を求める(マウス操作・ログ再生用)
+    角度は0.1度単位に丸める。スティックの分解能では1段階未満の差になる
+
+    Args:
+        angle (float): 角度(度)。右が0度で反時計回り
+        magnitude (float): 倒す量(0.0-1.0)
+
+    Returns:
+        tuple: (x, y) y軸は下向き
+    """
+    i = int(round(angle * 10)) % ANGLE_STEPS
+    return int(128 + magnitude * _COS127[i]), int(128 - magnitude * _SIN127[i])
+
+
+def stickRow(left=None, right=None):
+    """
+    スティックだけを動かす入力行を作る。Noneを渡したスティックは変更しない
+
+    Args:
+        left (tuple): 左スティックの (x, y)
+        right (tuple): 右スティックの (x, y)
+
+    Returns:
+        str: Sender.writeRowに渡す行
+    """
+    if left is not None and right is not None:
+        return f'3 8 {_hex(left[0])} {_hex(left[1])} {_hex(right[0])} {_hex(right[1])}'
+    elif left is not None:
+        return f'2 8 {_hex(left[0])} {_hex(left[1])}'
+    elif right is not None:
+        return f'1 8 {_hex(right[0])} {_hex(right[1])}'
+    return '0 8'
+
 
 # serial format
 class SendFormat:
-    def __init__(self):
+    # This format structure needs to be the same as the one written in Joystick.c
+    # 入力のたびに作られるため、辞書ではなくスロットで状態を持つ
+    __slots__ = ('btn', 'hat', 'lx', 'ly', 'rx', 'ry', 'L_stick_changed', 'R_stick_changed', 'Hat_pos')
 
-        self._logger = getLogger(__name__)
-        self._logger.addHandler(NullHandler())
-        self._logger.setLevel(DEBUG)
-        self._logger.propagate = True
-
-        # This format structure needs to be the same as the one written in Joystick.c
-        self.format = OrderedDict([
-            ('btn', 0),  # send bit array for buttons
-            ('hat', Hat.CENTER),
-            ('lx', center),
-            ('ly', center),
-            ('rx', center),
-            ('ry', center),
-        ])
+    def __init__(self):
+        self.btn = 0  # send bit array for buttons
+        self.hat = Hat.CENTER
+        self.lx = center
+        self.ly = center
+        self.rx = center
+        self.ry = center
 
         self.L_stick_changed = False
         self.R_stick_changed = False
         self.Hat_pos = Hat.CENTER
 
+    @property
+    def format(self):
+        # 以前の辞書形式の表現(表示・デバッグ用のコピー)
+        return OrderedDict([('btn', self.btn), ('hat', self.hat),
+                            ('lx', self.lx), ('ly', self.ly), ('rx', self.rx), ('ry', self.ry)])
+
     def setButton(self, btns):
         for btn in btns:
-            self.format['btn'] |= btn
+            self.btn |= btn
 
     def unsetButton(self, btns):
         for btn in btns:
-            self.format['btn'] &= ~btn
+            self.btn &= ~btn
 
     def resetAllButtons(self):
-        self.format['btn'] = 0
+        self.btn = 0
 
     def setHat(self, btns):
-        # self._logger.debug(btns)
         if not btns:
-            self.format['hat'] = self.Hat_pos
+            self.hat = self.Hat_pos
         else:
             self.Hat_pos = btns[0]
-            self.format['hat'] = btns[0]  # takes only first element
+            self.hat = btns[0]  # takes only first element
 
     def unsetHat(self):
-        # if self.Hat_pos is not Hat.CENTER:
         self.Hat_pos = Hat.CENTER
-        self.format['hat'] = self.Hat_pos
+        self.hat = self.Hat_pos
 
     def setAnyDirection(self, dirs):
         for dir in dirs:
             if dir.stick == Stick.LEFT:
-                if self.format['lx'] != dir.x or self.format['ly'] != 255 - dir.y:
+                if self.lx != dir.x or self.ly != 255 - dir.y:
                     self.L_stick_changed = True
 
-                self.format['lx'] = dir.x
-                self.format['ly'] = 255 - dir.y  # NOTE: y axis directs under
+                self.lx = dir.x
+                self.ly = 255 - dir.y  # NOTE: y axis directs under
             elif dir.stick == Stick.RIGHT:
-                if self.format['rx'] != dir.x or self.format['ry'] != 255 - dir.y:
+                if self.rx != dir.x or self.ry != 255 - dir.y:
                     self.R_stick_changed = True
 
-                self.format['rx'] = dir.x
-                self.format['ry'] = 255 - dir.y
+                self.rx = dir.x
+                self.ry = 255 - dir.y
 
     def unsetDirection(self, dirs):
         if Tilt.UP in dirs or Tilt.DOWN in dirs:
-            self.format['ly'] = center
-            self.format['lx'] = self.fixOtherAxis(self.format['lx'])
+            self.ly = center
+            self.lx = self.fixOtherAxis(self.lx)
             self.L_stick_changed = True
         if Tilt.RIGHT in dirs or Tilt.LEFT in dirs:
-            self.format['lx'] = center
-            self.format['ly'] = self.fixOtherAxis(self.format['ly'])
+            self.lx = center
+            self.ly = self.fixOtherAxis(self.ly)
             self.L_stick_changed = True
         if Tilt.R_UP in dirs or Tilt.R_DOWN in dirs:
-            self.format['ry'] = center
-            self.format['rx'] = self.fixOtherAxis(self.format['rx'])
+            self.ry = center
+            self.rx = self.fixOtherAxis(self.rx)
             self.R_stick_changed = True
         if Tilt.R_RIGHT in dirs or Tilt.R_LEFT in dirs:
-            self.format['rx'] = center
-            self.format['ry'] = self.fixOtherAxis(self.format['ry'])
+            self.rx = center
+            self.ry = self.fixOtherAxis(self.ry)
             self.R_stick_changed = True
 
     # Use this to fix an either tilt to max when the other axis sets to 0
@@ -148,55 +200,37 @@ class SendFormat:
             return 0 if fix_target < center else 255
 
     def resetAllDirections(self):
-        self.format['lx'] = center
-        self.format['ly'] = center
-        self.format['rx'] = center
-        self.format['ry'] = center
+        self.lx = center
+        self.ly = center
+        self.rx = center
+        self.ry = center
         self.L_stick_changed = True
         self.R_stick_changed = True
         self.Hat_pos = Hat.CENTER
 
     def convert2str(self):
-        str_format = ''
-        str_L = ''
-        str_R = ''
-        str_Hat = ''
-        space = ' '
-
         # set bits array with stick flags
-        send_btn = int(self.format['btn']) << 2
-        # send_btn |= 0x3
+        send_btn = int(self.btn) << 2
+        str_sticks = ''
         if self.L_stick_changed:
             send_btn |= 0x2
-            str_L = format(self.format['lx'], 'x') + space + format(self.format['ly'], 'x')
+            str_sticks += f" {_hex(self.lx)} {_hex(self.ly)}"
         if self.R_stick_changed:
             send_btn |= 0x1
-            str_R = format(self.format['rx'], 'x') + space + format(self.format['ry'], 'x')
-        # if self.Hat_changed:
-        str_Hat = str(int(self.format['hat']))
-        # format(send_btn, 'x') + \
-        # print(hex(send_btn))
-        str_format = format(send_btn, '#06x') + \
-                     (space + str_Hat) + \
-                     (space + str_L if self.L_stick_changed else '') + \
-                     (space + str_R if self.R_stick_changed else '')
+            str_sticks += f" {_hex(self.rx)} {_hex(self.ry)}"
 
         self.L_stick_changed = False
         self.R_stick_changed = False
 
-        # print(str_format)
-        return str_format  # the last space is not needed
+        # ex) 0x0008 8 80 80
+        return f"{send_btn:#06x} {int(self.hat)}{str_sticks}"
 
 
 # This class handle L stick and R stick at any angles
 class Direction:
-    def __init__(self, stick, angle, magnification=1.0, isDegree=True, showName=None):
-
-        self._logger = getLogger(__name__)
-        self._logger.addHandler(NullHandler())
-        self._logger.setLevel(DEBUG)
-        self._logger.propagate = True
+    __slots__ = ('stick', 'angle_for_show', 'showName', 'mag', 'x', 'y')
 
+    def __init__(self, stick, angle, magnification=1.0, isDegree=True, showName=None):
         self.stick = stick
         self.angle_for_show = angle
         self.showName = showName
@@ -214,13 +248,19 @@ class Direction:
             self.showName = '(' + str(self.x) + ', ' + str(self.y) + ')'
             print('押し込み量', self.showName)
         else:
-            angle = math.radians(angle) if isDegree else angle
+            i = int(angle * 10) if isDegree and 0 <= angle < 360 else -1
+            if i >= 0 and i / 10 == angle:
+                # 0.1度単位の角度はテーブルの値を使う(math.cosと同じ値になる)
+                cos, sin = _COS[i], _SIN[i]
+            else:
+                angle = math.radians(angle) if isDegree else angle
+                cos, sin = math.cos(angle), math.sin(angle)
 
             # We set stick X and Y from 0 to 255, so they are calculated as below.
             # X = 127.5*cos(theta) + 127.5
             # Y = 127.5*sin(theta) + 127.5
-            self.x = math.ceil(127.5 * math.cos(angle) * self.mag + 127.5)
-            self.y = math.floor(127.5 * math.sin(angle) * self.mag + 127.5)
+            self.x = math.ceil(127.5 * cos * self.mag + 127.5)
+            self.y = math.floor(127.5 * sin * self.mag + 127.5)
 
     def __repr__(self):
         if self.showName:
@@ -285,33 +325,21 @@ Direction.R_UP_LEFT = Direction(Stick.RIGHT, 135, showName='UP_LEFT')
 
 # handles serial input to Joystick.c
 class KeyPress:
-    def __init__(self, ser):
-
-        self._logger = getLogger(__name__)
-        self._logger.addHandler(NullHandler())
-        self._logger.setLevel(DEBUG)
-        self._logger.propagate = True
+    __slots__ = ('ser', 'format', 'holdButton', 'last_ticket', 'input_time_0')
 
-        self.q = queue.Queue()
+    def __init__(self, ser):
+        # 直前に書き込みキューへ入れた行の控え(Sender.WriteTicket)。冗長で送らなかった場合はNone
+        self.last_ticket = None
         self.ser = ser
         self.format = SendFormat()
         self.holdButton = []
-        self.btn_name2 = ['LEFT', 'RIGHT', 'UP', 'DOWN', 'UP_LEFT', 'UP_RIGHT', 'DOWN_LEFT', 'DOWN_RIGHT']
-
-        self.pushing_to_show = None
-        self.pushing = None
-        self.pushing2 = None
-        self._pushing = None
-        self._chk_neutral = None
-        self.NEUTRAL = dict(self.format.format)
-
         self.input_time_0 = time.perf_counter()
-        self.input_time_1 = time.perf_counter()
-        self.inputEnd_time_0 = time.perf_counter()
-        self.was_neutral = True
 
     def input(self, btns, ifPrint=True):
-        self._pushing = dict(self.format.format)
+        self.last_ticket = self.ser.writeRow(self._applyInput(btns))
+        self.input_time_0 = time.perf_counter()
+
+    def _applyInput(self, btns):
         if not isinstance(btns, list):
             btns = [btns]
 
@@ -323,19 +351,22 @@ class KeyPress:
         self.format.setHat([btn for btn in btns if type(btn) is Hat])
         self.format.setAnyDirection([btn for btn in btns if type(btn) is Direction])
 
-        self.ser.writeRow(self.format.convert2str())
-        self.input_time_0 = time.perf_counter()
-
-        # self._logger.debug(f": {list(map(str,self.format.format.values()))}")
+        return self.format.convert2str()
 
     def inputEnd(self, btns, ifPrint=True, unset_hat=True):
-        # self._logger.debug(f"input end: {btns}")
-        self.pushing2 = dict(self.format.format)
+        self.last_ticket = self.ser.writeRow(self._applyInputEnd(btns, unset_hat))
+
+    # Send a press and its release as one row; the firmware counts the reports while pressing
+    # 押している時間はファームウェアがレポート数で数えるので、離す行を送る必要がありません
+    def inputHold(self, btns, reports):
+        press_row = self._applyInput(btns)
+        self.input_time_0 = time.perf_counter()
+        release_row = self._applyInputEnd(btns)
+        self.last_ticket = self.ser.writeHold(press_row, reports, release_row)
 
-        self.ed = time.perf_counter()
+    def _applyInputEnd(self, btns, unset_hat=True):
         if not isinstance(btns, list):
             btns = [btns]
-        # self._logger.debug(btns)
 
         # get tilting direction from angles
         tilts = []
@@ -343,13 +374,12 @@ class KeyPress:
             tiltings = dir.getTilting()
             for tilting in tiltings:
                 tilts.append(tilting)
-        # self._logger.debug(tilts)
 
         self.format.unsetButton([btn for btn in btns if type(btn) is Button])
         if unset_hat:
             self.format.unsetHat()
         self.format.unsetDirection(tilts)
-        self.ser.writeRow(self.format.convert2str())
+        return self.format.convert2str()
 
     def hold(self, btns):
         if not isinstance(btns, list):
@@ -358,7 +388,7 @@ class KeyPress:
         for btn in btns:
             if btn in self.holdButton:
                 print('Warning: ' + btn.name + ' is already in holding state')
-                self._logger.warning(f"Warning: {btn.name} is already in holding state")
+                logger.warning(f"Warning: {btn.name} is already in holding state")
                 return
 
             self.holdButton.append(btn)
@@ -374,7 +404,7 @@ class KeyPress:
         self.inputEnd(btns)
 
     def end(self):
-        self.ser.writeRow('end')
+        self.last_ticket = self.ser.writeRow('end')
 
     def serialcommand_direct_send(self, serialcommands: list, waittime: list):
         for wtime, row in zip(waittime, serialcommands):
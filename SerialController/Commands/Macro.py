@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from enum import IntEnum
+
+from .Keys import Button, Direction
+
+# Joystick.cのMACRO_MAX_STEPSと同じ値にする
+MACRO_MAX_STEPS = 24
+# 1行で送るステップ数(行はMAX_BUFFERに収める)
+STEPS_PER_ROW = 3
+# 1ステップの最大のレポート数。Joystick.cのduration_bufは符号付き16bitのint
+MACRO_MAX_DURATION = 0x7FFF
+# Switchがレポートを読み出す間隔(s)。レポート数で数える時間(hold、MacroSequence)はすべてこの値から求める
+# Joystick.hのREPORT_INTERVAL_MSと同じ値にする
+REPORT_INTERVAL = 0.008
+
+
+# This enum needs to be the same as Buttons_t written in Joystick.h
+class McuButton(IntEnum):
+    UP = 0
+    DOWN = 1
+    LEFT = 2
+    RIGHT = 3
+    UPLEFT = 4
+    UPRIGHT = 5
+    DOWNLEFT = 6
+    DOWNRIGHT = 7
+    X = 8
+    Y = 9
+    A = 10
+    B = 11
+    L = 12
+    R = 13
+    PLUS = 14
+    MINUS = 15
+    NOP = 16
+    TRIGGERS = 17
+    HOME = 18
+    RS_UP = 19
+    RS_DOWN = 20
+    RS_LEFT = 21
+    RS_RIGHT = 22
+    RS_UPLEFT = 23
+    RS_UPRIGHT = 24
+    RS_DOWNLEFT = 25
+    RS_DOWNRIGHT = 26
+
+
+_BUTTONS = {
+    Button.A: McuButton.A,
+    Button.B: McuButton.B,
+    Button.X: McuButton.X,
+    Button.Y: McuButton.Y,
+    Button.L: McuButton.L,
+    Button.R: McuButton.R,
+    Button.L | Button.R: McuButton.TRIGGERS,
+    Button.PLUS: McuButton.PLUS,
+    Button.MINUS: McuButton.MINUS,
+    Button.HOME: McuButton.HOME,
+}
+
+_DIRECTIONS = [
+    (Direction.UP, McuButton.UP),
+    (Direction.DOWN, McuButton.DOWN),
+    (Direction.LEFT, McuButton.LEFT),
+    (Direction.RIGHT, McuButton.RIGHT),
+    (Direction.UP_LEFT, McuButton.UPLEFT),
+    (Direction.UP_RIGHT, McuButton.UPRIGHT),
+    (Direction.DOWN_LEFT, McuButton.DOWNLEFT),
+    (Direction.DOWN_RIGHT, McuButton.DOWNRIGHT),
+    (Direction.R_UP, McuButton.RS_UP),
+    (Direction.R_DOWN, McuButton.RS_DOWN),
+    (Direction.R_LEFT, McuButton.RS_LEFT),
+    (Direction.R_RIGHT, McuButton.RS_RIGHT),
+    (Direction.R_UP_LEFT, McuButton.RS_UPLEFT),
+    (Direction.R_UP_RIGHT, McuButton.RS_UPRIGHT),
+    (Direction.R_DOWN_LEFT, McuButton.RS_DOWNLEFT),
+    (Direction.R_DOWN_RIGHT, McuButton.RS_DOWNRIGHT),
+]
+
+
+def toMcuButton(button):
+    if isinstance(button, McuButton):
+        return button
+    if isinstance(button, Button) and button in _BUTTONS:
+        return _BUTTONS[button]
+    for direction, mcu_button in _DIRECTIONS:
+        if direction == button:
+            return mcu_button
+    raise ValueError(f"{button!r} cannot be used in an MCU macro")
+
+
+class MacroSequence:
+    """
+    MCUのRAMに送って実行させる入力の並び
+
+    Commands.cの`Command[]`と同じく、ボタン1つと継続時間の組を並べる。継続時間はレポート数で数えるため、
+    PCから1回ずつ送るよりも正確なタイミングで入力できる。使えるのはJoystick.hのButtons_tにある入力のみ。
+
+        seq = MacroSequence().press(Button.A, duration=0.05, wait=0.5).press(Direction.DOWN)
+        self.runMacro(seq, repeat=10)
+    """
+
+    def __init__(self, report_interval=REPORT_INTERVAL):
+        self.report_interval = report_interval
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def _toReports(self, duration):
+        # ファームウェアは (duration + 1) レポートの間同じ入力を続ける
+        return min(MACRO_MAX_DURATION, max(0, round(duration / self.report_interval) - 1))
+
+    def press(self, button, duration=0.1, wait=0.1):
+        self.steps.append((toMcuButton(button), self._toReports(duration)))
+        if wait > 0:
+            self.wait(wait)
+        return self
+
+    def wait(self, wait):
+        self.steps.append((McuButton.NOP, self._toReports(wait)))
+        return self
+
+    def totalTime(self):
+        # 1回分の実行にかかる時間(s)。最後に中立のレポートが1回入る
+        return (sum(duration + 1 for _, duration in self.steps) + 1) * self.report_interval
+
+    def toRows(self):
+        """
+        Returns:
+            list: `mstep`で始まるアップロード用の行
+        """
+        if not 0 < len(self.steps) <= MACRO_MAX_STEPS:
+            raise ValueError(f"An MCU macro needs 1 to {MACRO_MAX_STEPS} steps: {len(self.steps)}")
+        rows = []
+        for i in range(0, len(self.steps), STEPS_PER_ROW):
+            values = [f"{int(button):x} {duration:x}" for button, duration in self.steps[i:i + STEPS_PER_ROW]]
+            rows.append('mstep ' + ' '.join(values))
+        return rows
@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import threading
+
 from . import CommandBase
 
 
 # MCU command
 class McuCommand(CommandBase.Command):
-    def __init__(self, sync_name):
+    # sequenceを渡すと、ファームウェアに書き込まれたコマンドの代わりにMCUのRAMへ送って実行します
+    # (Macro.MacroSequence, repeatが0の場合は止めるまで繰り返す)
+    def __init__(self, sync_name=None, sequence=None, repeat=0):
         super(McuCommand, self).__init__()
         self.sync_name = sync_name
+        self.sequence = sequence
+        self.repeat = repeat
         self.postProcess = None
+        self.thread = None
 
     def start(self, ser, postProcess):
-        ser.writeRow(self.sync_name)
         self.isRunning = True
         self.postProcess = postProcess
+        if self.sequence is None:
+            ser.writeRow(self.sync_name)
+            return
+        # 送り終えるまで応答を待つので、GUIのスレッドを止めないよう別のスレッドで送る
+        self.thread = threading.Thread(target=self.upload, args=(ser,), daemon=True)
+        self.thread.start()
+
+    def upload(self, ser):
+        if ser.uploadMacro(self.sequence):
+            if self.isRunning:
+                ser.runMacro(self.repeat)
+        elif self.sync_name is not None and self.isRunning:
+            # RAMに送れなかった場合は、ファームウェアに書き込まれたコマンドを使う
+            ser.writeRow(self.sync_name)
 
     def end(self, ser):
         ser.writeRow('end')
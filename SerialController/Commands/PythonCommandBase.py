@@ -8,15 +8,25 @@ from abc import abstractclassmethod
 from time import sleep
 import random
 import time
+from collections import namedtuple
+from contextlib import contextmanager
 from logging import getLogger, DEBUG, NullHandler
 from os import path
 import tkinter as tk
 import tkinter.ttk as ttk
 
 import Settings
+from Camera import BASE_RESOLUTION, scaleRect
 from LineNotify import Line_Notify
+from TemplateCache import template_cache
+from TemplateRoi import roi_registry
+from TemplateMatching import TemplateSet, findAllTemplates, fitCrop, matchTemplate, matchTemplatePyramid, prepareSource
 from . import CommandBase
-from .Keys import Button, Direction, KeyPress
+from .Keys import Button, Direction, KeyPress, SendFormat
+from .Macro import REPORT_INTERVAL
+from .Sender import formatState
+from .Timer import InputTimeline, PreciseTimer
+from .Trace import NEUTRAL_STATE, TraceReader
 
 import numpy as np
 
@@ -36,6 +46,11 @@ class PythonCommand(CommandBase.Command):
         self.postProcess = None
         self.Line = Line_Notify()
         self.message_dialogue = None
+        self.timer = PreciseTimer()
+        # Trueにすると、ファームウェアが対応していればpress()の押している時間をファームウェアが数える
+        # (Noneの場合は設定のuse_mcu_holdに従う)
+        self.use_mcu_hold = None
+        self._timeline = None
 
         self._logger = getLogger(__name__)
         self._logger.addHandler(NullHandler())
@@ -50,6 +65,7 @@ class PythonCommand(CommandBase.Command):
         if self.keys is None:
             self.keys = KeyPress(ser)
 
+        self.timer.reset()
         try:
             if self.alive:
                 self.do()
@@ -66,6 +82,8 @@ class PythonCommand(CommandBase.Command):
             traceback.print_exc()
             self.keys.end()
             self.alive = False
+        finally:
+            self.timer.logStats()
 
     def start(self, ser, postProcess=None):
         self.alive = True
@@ -90,9 +108,15 @@ class PythonCommand(CommandBase.Command):
 
     # press button at duration times(s)
     def press(self, buttons, duration=0.1, wait=0.1):
-        self.keys.input(buttons)
-        self.wait(duration)
-        self.keys.inputEnd(buttons)
+        reports = round(duration / REPORT_INTERVAL)
+        use_hold = self.keys.ser.use_hold if self.use_mcu_hold is None else self.use_mcu_hold
+        if use_hold and self.keys.ser.has_hold and 0 < reports <= 0xFFFF:
+            self.keys.inputHold(buttons, reports)
+            self.wait(duration)
+        else:
+            self.keys.input(buttons)
+            self.wait(duration)
+            self.keys.inputEnd(buttons)
         self.wait(wait)
         self.checkIfAlive()
 
@@ -114,21 +138,72 @@ class PythonCommand(CommandBase.Command):
 
     # do nothing at wait time(s)
     def short_wait(self, wait):
-        current_time = time.perf_counter()
-        while time.perf_counter() < current_time + wait:
-            pass
+        self.timer.sleep(wait)
         self.checkIfAlive()
 
     # do nothing at wait time(s)
+    # 期限の直前までsleepし、最後だけスピンするので押下時間の精度を保ったままCPUを占有しない
     def wait(self, wait):
-        if float(wait) > 0.1:
-            sleep(wait)
+        if self._timeline is not None:
+            self._timeline.wait(wait)
         else:
-            current_time = time.perf_counter()
-            while time.perf_counter() < current_time + wait:
-                pass
+            self.timer.sleep(wait)
         self.checkIfAlive()
+
+    # Schedule the waits inside the block against absolute deadlines from the start of the sequence
+    # with self.inputSequence(): の中では、待機の誤差が積み重ならないよう開始時刻からの期限に合わせて入力します
+    @contextmanager
+    def inputSequence(self, resync=0.1):
+        outer = self._timeline
+        if outer is not None:
+            # 入れ子の場合は外側のタイムラインをそのまま使う
+            yield outer
+            return
+        self._timeline = InputTimeline(self.timer, resync)
+        try:
+            yield self._timeline
+        finally:
+            self._logger.debug("Input sequence: " + self._timeline.report())
+            self._timeline = None
     
+    # Run a sequence (Macro.MacroSequence) on the MCU with report-interval timing
+    # MCUのRAMに入力の並びを送って実行します。waitがTrueの場合は実行が終わるまで待ちます
+    def runMacro(self, sequence, repeat=1, wait=True):
+        if not self.keys.ser.uploadMacro(sequence):
+            self._logger.warning('Failed to upload a macro')
+            return False
+        self.keys.ser.runMacro(repeat)
+        if wait and repeat > 0:
+            deadline = time.perf_counter() + sequence.totalTime() * repeat + 1.0
+            while not self.keys.ser.waitMacro(0.1):
+                self.checkIfAlive()
+                if time.perf_counter() > deadline:
+                    self._logger.warning('Macro did not finish in time')
+                    return False
+        self.checkIfAlive()
+        return True
+
+    # Replay inputs recorded by Trace.TraceRecorder at the recorded timing
+    # 記録した入力を、記録した時刻に合わせて再生します。ファイルは少しずつ読むので長い記録も再生できます
+    def playTrace(self, path, speed=1.0, max_wait=0.5):
+        with TraceReader(path) as trace, self.inputSequence() as timeline:
+            self._logger.debug(f"Play a trace: {len(trace)} inputs in {trace.duration():.3f} s")
+            prev_ns = 0
+            for t_ns, state in trace:
+                wait = (t_ns - prev_ns) / 1e9 / speed
+                prev_ns = t_ns
+                # 長い待機は分けて、途中で停止できるようにする
+                while wait > max_wait:
+                    timeline.wait(max_wait)
+                    wait -= max_wait
+                    self.checkIfAlive()
+                timeline.wait(wait)
+                # 記録した時刻どおりに送るため、まとめずにすぐ送る
+                self.keys.ser.writeRow(formatState(state), coalesce=False)
+                self.checkIfAlive()
+        self.keys.ser.writeRow(formatState(NEUTRAL_STATE))
+        self.keys.format = SendFormat()
+
     def checkIfAlive(self):
         if not self.alive:
             self.keys.end()
@@ -155,49 +230,50 @@ class PythonCommand(CommandBase.Command):
 
     # Controls the system time and get every-other-day bonus without any punishments
     def timeLeap(self, is_go_back=True):
-        self.press(Button.HOME, wait=1)
-        self.press(Direction.DOWN)
-        self.press(Direction.RIGHT)
-        self.press(Direction.RIGHT)
-        self.press(Direction.RIGHT)
-        self.press(Direction.RIGHT)
-        self.press(Direction.RIGHT)
-        self.press(Button.A, wait=1.5)  # System Settings
-        self.press(Direction.DOWN, duration=2, wait=0.5)
-
-        self.press(Button.A, wait=0.3)  # System Settings > System
-        self.press(Direction.DOWN)
-        self.press(Direction.DOWN)
-        self.press(Direction.DOWN)
-        self.press(Direction.DOWN, wait=0.3)
-        self.press(Button.A, wait=0.2)  # Date and Time
-        self.press(Direction.DOWN, duration=0.7, wait=0.2)
-
-        # increment and decrement
-        if is_go_back:
-            self.press(Button.A, wait=0.2)
-            self.press(Direction.UP, wait=0.2)  # Increment a year
-            self.press(Direction.RIGHT, duration=1.5)
-            self.press(Button.A, wait=0.5)
-
-            self.press(Button.A, wait=0.2)
-            self.press(Direction.LEFT, duration=1.5)
-            self.press(Direction.DOWN, wait=0.2)  # Decrement a year
-            self.press(Direction.RIGHT, duration=1.5)
-            self.press(Button.A, wait=0.5)
-
-        # use only increment
-        # for use of faster time leap
-        else:
-            self.press(Button.A, wait=0.2)
+        with self.inputSequence():
+            self.press(Button.HOME, wait=1)
+            self.press(Direction.DOWN)
+            self.press(Direction.RIGHT)
+            self.press(Direction.RIGHT)
             self.press(Direction.RIGHT)
             self.press(Direction.RIGHT)
-            self.press(Direction.UP, wait=0.2)  # increment a day
-            self.press(Direction.RIGHT, duration=1)
-            self.press(Button.A, wait=0.5)
+            self.press(Direction.RIGHT)
+            self.press(Button.A, wait=1.5)  # System Settings
+            self.press(Direction.DOWN, duration=2, wait=0.5)
+
+            self.press(Button.A, wait=0.3)  # System Settings > System
+            self.press(Direction.DOWN)
+            self.press(Direction.DOWN)
+            self.press(Direction.DOWN)
+            self.press(Direction.DOWN, wait=0.3)
+            self.press(Button.A, wait=0.2)  # Date and Time
+            self.press(Direction.DOWN, duration=0.7, wait=0.2)
+
+            # increment and decrement
+            if is_go_back:
+                self.press(Button.A, wait=0.2)
+                self.press(Direction.UP, wait=0.2)  # Increment a year
+                self.press(Direction.RIGHT, duration=1.5)
+                self.press(Button.A, wait=0.5)
+
+                self.press(Button.A, wait=0.2)
+                self.press(Direction.LEFT, duration=1.5)
+                self.press(Direction.DOWN, wait=0.2)  # Decrement a year
+                self.press(Direction.RIGHT, duration=1.5)
+                self.press(Button.A, wait=0.5)
+
+            # use only increment
+            # for use of faster time leap
+            else:
+                self.press(Button.A, wait=0.2)
+                self.press(Direction.RIGHT)
+                self.press(Direction.RIGHT)
+                self.press(Direction.UP, wait=0.2)  # increment a day
+                self.press(Direction.RIGHT, duration=1)
+                self.press(Button.A, wait=0.5)
 
-        self.press(Button.HOME, wait=1)
-        self.press(Button.HOME, wait=1)
+            self.press(Button.HOME, wait=1)
+            self.press(Button.HOME, wait=1)
 
     def LINE_text(self, txt="", token='token'):
         self.Line.send_text(txt, token)
@@ -297,6 +373,9 @@ class PokeConDialogue(object):
         self.isOK = False
 
 
+# wait_any / wait_until の結果
+WaitResult = namedtuple('WaitResult', ['index', 'condition', 'frame_id', 'timestamp', 'elapsed'])
+
 TEMPLATE_PATH = "./Template/"
 def _get_template_filespec(template_path: str) -> str:
     """
@@ -316,6 +395,14 @@ def _get_template_filespec(template_path: str) -> str:
         return path.join(TEMPLATE_PATH, template_path)
 
 
+def _toBase(coords, size):
+    # フレームの解像度sizeの座標の配列(列は x, y の繰り返し)をBASE_RESOLUTIONの座標に直す
+    if tuple(size) == BASE_RESOLUTION or len(coords) == 0:
+        return coords
+    ratio = np.array([BASE_RESOLUTION[0] / size[0], BASE_RESOLUTION[1] / size[1]] * (coords.shape[1] // 2))
+    return np.rint(coords * ratio).astype(coords.dtype)
+
+
 class ImageProcPythonCommand(PythonCommand):
     def __init__(self, cam, gui=None):
         super(ImageProcPythonCommand, self).__init__()
@@ -334,98 +421,230 @@ class ImageProcPythonCommand(PythonCommand):
         self.gtmpl = cv2.cuda_GpuMat()
         self.gresult = cv2.cuda_GpuMat()
 
+        self._last_frame_id = 0
+        self._match_memo = {}  # (template_path, use_gray, crop, pyramid_levels) -> (frame_id, max_val, max_loc, w, h)
+        self._template_sets = {}
+
+        # Search only the registered region of each template (see TemplateRoi.py)
+        # roi_learningをTrueにすると、マッチした位置を記録して探索範囲を学習します
+        self.use_roi = True
+        self.roi_learning = False
+
+    def do_safe(self, ser):
+        try:
+            super(ImageProcPythonCommand, self).do_safe(ser)
+        finally:
+            roi_registry.save()
+
+    # Load templates into the shared cache beforehand (e.g. in __init__ of a command)
+    # コマンドの__init__などで呼び出し、初回のマッチングでファイル読み込みが発生しないようにします
+    def preloadTemplates(self, template_path_list, use_gray=True):
+        if not isinstance(template_path_list, list):
+            template_path_list = [template_path_list]
+        template_cache.preload([_get_template_filespec(p) for p in template_path_list], use_gray)
+
+    # Pass the current capture size to get the template scaled from the resolution it was cut out at
+    # sizeに現在のキャプチャ解像度を渡すと、その解像度に合わせて拡大・縮小したテンプレートを返します
+    def loadTemplate(self, template_path, use_gray=True, size=None):
+        return template_cache.get(_get_template_filespec(template_path), use_gray, size)
+
+    # Get the latest frame. If new_frame is True, wait for a frame newer than the one used last time
+    # new_frame=Trueの場合は、前回使ったフレームより新しいフレームが届くまで待ちます
+    # Returns a Camera.Frame, which caches the gray and downscaled images for all checks on the same frame
+    def _readFrame(self, new_frame=False):
+        frame = self.camera.getFrame(self._last_frame_id if new_frame else None)
+        if frame is not None:
+            self._last_frame_id = frame.frame_id
+        return frame
+
+    # Returns (max_val, max_loc, w, h). The result of the last frame is memoized per template,
+    # so the same frame is never matched twice with the same template.
+    # テンプレートごとに直前のフレームの結果を保持し、同じフレームに対するマッチングを省略します
+    def _matchTemplate(self, get_src, frame_id, template_path, use_gray, crop, pyramid_levels=0, threshold=0.7,
+                       get_small_src=None, size=None):
+        # ピラミッド探索は閾値によって等倍での探索に切り替わるため、閾値もキーに含める
+        key = (template_path, use_gray, tuple(crop), pyramid_levels, size, threshold if pyramid_levels > 0 else None)
+        memo = self._match_memo.get(key)
+        if memo is not None and memo[0] == frame_id:
+            return memo[1:]
+
+        template = self.loadTemplate(template_path, use_gray, size)
+        w, h = template.shape[1], template.shape[0]
+
+        if pyramid_levels > 0:
+            max_val, max_loc = matchTemplatePyramid(get_src(), template, pyramid_levels, threshold,
+                                                    get_small_src=get_small_src)
+        else:
+            max_val, max_loc = matchTemplate(get_src(), template)
+
+        self._match_memo[key] = (frame_id, max_val, max_loc, w, h)
+        return max_val, max_loc, w, h
+
+    def _showMatchRect(self, max_val, threshold, max_loc, w, h, show_position, show_only_true_rect, ms):
+        if self.gui is None or not show_position:
+            return
+        if max_val < threshold and show_only_true_rect:
+            return
+        top_left = max_loc
+        bottom_right = (top_left[0] + w + 1, top_left[1] + h + 1)
+        tag = str(time.perf_counter()) + str(random.random())
+        # self.gui.delete("ImageRecRect")
+        self.gui.ImgRect(*top_left,
+                         *bottom_right,
+                         outline='blue' if max_val >= threshold else 'red',
+                         tag=tag,
+                         ms=ms)
+
     # Judge if current screenshot contains an image using template matching
     # It's recommended that you use gray_scale option unless the template color wouldn't be cared for performace
+    # Set new_frame to True to wait for a frame that has not been checked yet
+    # Set pyramid_levels to search downscaled images first (faster for large templates)
     # 現在のスクリーンショットと指定した画像のテンプレートマッチングを行います
     # 色の違いを考慮しないのであればパフォーマンスの点からuse_grayをTrueにしてグレースケール画像を使うことを推奨します
+    # new_frame=Trueにすると、まだ判定していない新しいフレームが届くまで待ってから判定します
+    # pyramid_levelsを指定すると縮小画像で候補を探してから等倍で確認します(大きなテンプレートほど高速になります)
     def isContainTemplate(self, template_path, threshold=0.7, use_gray=True,
-                          show_value=False, show_position=True, show_only_true_rect=True, ms=2000, crop=[]):
-        src = self.camera.readFrame()
-        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY) if use_gray else src
-        
+                          show_value=False, show_position=True, show_only_true_rect=True, ms=2000, crop=[],
+                          new_frame=False, pyramid_levels=0):
+        frame = self._readFrame(new_frame)
+        return self._judgeTemplate(frame, template_path, threshold, use_gray, show_value,
+                                   show_position, show_only_true_rect, ms, crop, pyramid_levels)
+
+    def _judgeTemplate(self, frame, template_path, threshold=0.7, use_gray=True, show_value=False,
+                       show_position=True, show_only_true_rect=True, ms=2000, crop=[], pyramid_levels=0):
+        # crop・探索範囲・表示する座標はBASE_RESOLUTIONの座標系で扱い、マッチングだけをフレームの解像度で行う
+        if len(crop) != 4 and self.use_roi:
+            crop = roi_registry.getCrop(template_path, BASE_RESOLUTION[::-1])
+        size = frame.size
         if len(crop) == 4:
-            src = src[crop[1]: crop[3], crop[0]: crop[2]]
-        
-        template = cv2.imread(_get_template_filespec(template_path), cv2.IMREAD_GRAYSCALE if use_gray else cv2.IMREAD_COLOR)
-        w, h = template.shape[1], template.shape[0]
-
-        method = cv2.TM_CCOEFF_NORMED
-        res = cv2.matchTemplate(src, template, method)
-        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+            # 余白を付けても探索範囲がテンプレートより小さくなることがある
+            template = self.loadTemplate(template_path, use_gray, size)
+            crop = fitCrop(scaleRect(crop, BASE_RESOLUTION, size), template.shape[1::-1], size)
+        # グレースケール・縮小画像はフレームごとに1回だけ作る
+        get_small_src = None
+        if len(crop) != 4 and pyramid_levels > 0:
+            get_small_src = lambda: frame.scaled(2 ** pyramid_levels, use_gray)
+        max_val, max_loc, w, h = self._matchTemplate(
+            lambda: prepareSource(frame.gray() if use_gray else frame.image, use_gray, crop),
+            frame.frame_id, template_path, use_gray, crop, pyramid_levels, threshold, get_small_src, size)
+        if len(crop) == 4:
+            # 切り出し範囲内の座標をフレーム全体の座標に直す
+            max_loc = (max_loc[0] + crop[0], max_loc[1] + crop[1])
+        x, y, w, h = scaleRect([max_loc[0], max_loc[1], w, h], size, BASE_RESOLUTION)
+        max_loc = (x, y)
+        if self.roi_learning and max_val >= threshold:
+            roi_registry.learn(template_path, max_loc, w, h)
 
         if show_value:
             print(template_path + ' ZNCC value: ' + str(max_val))
 
-        top_left = max_loc
-        bottom_right = (top_left[0] + w + 1, top_left[1] + h + 1)
-        tag = str(time.perf_counter()) + str(random.random())
-        if max_val >= threshold:
-            if self.gui is not None and show_position:
-                # self.gui.delete("ImageRecRect")
-                self.gui.ImgRect(*top_left,
-                                 *bottom_right,
-                                 outline='blue',
-                                 tag=tag,
-                                 ms=ms)
-            return True
-        else:
-            if self.gui is not None and show_position and not show_only_true_rect:
-                # self.gui.delete("ImageRecRect")
-                self.gui.ImgRect(*top_left,
-                                 *bottom_right,
-                                 outline='red',
-                                 tag=tag,
-                                 ms=ms)
-            return False
-    
+        self._showMatchRect(max_val, threshold, max_loc, w, h, show_position, show_only_true_rect, ms)
+        return max_val >= threshold
+
+    # Find every position of a template in the current frame with one matchTemplate and NMS
+    # Returns (boxes, scores): boxes is an (N, 4) array of [x1, y1, x2, y2], sorted by score
+    # 画面内にあるテンプレートの位置を1回のマッチングで全て探します(ボックスに並んだアイコンなど)
+    # nms_overlapより大きく重なった候補は、相関値の高いものだけを残します
+    def findAllTemplates(self, template_path, threshold=0.8, nms_overlap=0.3, use_gray=True,
+                         show_position=True, ms=2000, crop=[], new_frame=False):
+        frame = self._readFrame(new_frame)
+        template = self.loadTemplate(template_path, use_gray, frame.size)
+        if len(crop) == 4:
+            crop = fitCrop(scaleRect(crop, BASE_RESOLUTION, frame.size), template.shape[1::-1], frame.size)
+        src = prepareSource(frame.gray() if use_gray else frame.image, use_gray, crop)
+        boxes, scores = findAllTemplates(src, template, threshold, nms_overlap)
+        if len(crop) == 4:
+            boxes += np.array([crop[0], crop[1], crop[0], crop[1]], dtype=np.int32)
+        boxes = _toBase(boxes, frame.size)
+
+        for (x1, y1, x2, y2), score in zip(boxes.tolist(), scores.tolist()):
+            self._showMatchRect(score, threshold, (x1, y1), x2 - x1, y2 - y1, show_position, True, ms)
+        return boxes, scores
+
+    # Wait until one of the conditions is satisfied on a newly captured frame
+    # A condition is a template path, a (template path, threshold) tuple or a function that takes a frame
+    # Returns WaitResult(index, condition, frame_id, timestamp, elapsed), or None if timed out
+    # 新しいフレームが届くたびに条件を判定し、いずれかの条件を満たした時点で戻ります
+    # 条件にはテンプレート画像のパス、(パス, 閾値)のタプル、フレームを受け取ってboolを返す関数を指定できます
+    # timeout秒以内に満たされなかった場合はNoneを返します
+    def wait_any(self, conditions, timeout=None, min_interval=0.0, threshold=0.7, use_gray=True,
+                 show_position=True, crop=[]):
+        start = time.perf_counter()
+        last_eval = None
+        while True:
+            self.checkIfAlive()
+            now = time.perf_counter()
+            if timeout is not None and now - start >= timeout:
+                return None
+            if last_eval is not None and now - last_eval < min_interval:
+                sleep(min(min_interval - (now - last_eval), 0.1))
+                continue
+
+            # 停止要求に応じられるよう、待ち時間は短く区切る
+            slice_time = 0.1 if timeout is None else max(0.0, min(0.1, start + timeout - now))
+            frame = self.camera.getFrame(self._last_frame_id, slice_time)
+            if frame is None or frame.frame_id == self._last_frame_id:
+                continue
+            self._last_frame_id = frame.frame_id
+            last_eval = time.perf_counter()
+
+            for i, condition in enumerate(conditions):
+                if callable(condition):
+                    is_satisfied = condition(frame.image)
+                else:
+                    template_path, th = condition if isinstance(condition, tuple) else (condition, threshold)
+                    is_satisfied = self._judgeTemplate(frame, template_path, th, use_gray,
+                                                       show_position=show_position, crop=crop)
+                if is_satisfied:
+                    return WaitResult(i, condition, frame.frame_id, frame.timestamp, frame.timestamp - start)
+
+    def wait_until(self, condition, timeout=None, min_interval=0.0, threshold=0.7, use_gray=True,
+                   show_position=True, crop=[]):
+        return self.wait_any([condition], timeout, min_interval, threshold, use_gray, show_position, crop)
+
+    # Create a TemplateSet that matches several templates at once with shared preprocessing
+    # 複数のテンプレートをまとめてマッチングするTemplateSetを作成します
+    def createTemplateSet(self, template_path_list, use_gray=True):
+        return TemplateSet([_get_template_filespec(p) for p in template_path_list], use_gray)
+
+    # Returns (scores, locs) of all templates in the set as NumPy arrays
+    # セット内の全テンプレートの相関値と位置をNumPy配列で返します(座標はBASE_RESOLUTIONの座標系)
+    def matchTemplateSet(self, template_set, crop=[], new_frame=False):
+        frame = self._readFrame(new_frame)
+        key = (template_set, tuple(crop))
+        memo = self._match_memo.get(key)
+        if memo is not None and memo[0] == frame.frame_id:
+            return memo[1:]
+
+        frame_crop = scaleRect(crop, BASE_RESOLUTION, frame.size) if len(crop) == 4 else crop
+        scores, locs = template_set.match(frame.gray() if template_set.use_gray else frame.image, frame_crop,
+                                          size=frame.size)
+        locs = _toBase(locs, frame.size)
+        self._match_memo[key] = (frame.frame_id, scores, locs)
+        return scores, locs
+
     # 現在のスクリーンショットと指定した複数の画像のテンプレートマッチングを行います
     # 相関値が最も大きい値となった画像のインデックス、各画像のテンプレートマッチングの閾値、閾値判定結果を返します。
     # 色の違いを考慮しないのであればパフォーマンスの点からuse_grayをTrueにしてグレースケール画像を使うことを推奨します
     def isContainTemplate_max(self, template_path_list, threshold=0.7, use_gray=True,
-                              show_value=False, show_position=True, show_only_true_rect=True, ms=2000, crop=[]):
-        src = self.camera.readFrame()
-        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY) if use_gray else src
-        
-        if len(crop) == 4:
-            src = src[crop[1]: crop[3], crop[0]: crop[2]]
-        
-        max_val_list = []
-        judge_threshold_list = []
-        for template_path in template_path_list:
-            template = cv2.imread(_get_template_filespec(template_path), cv2.IMREAD_GRAYSCALE if use_gray else cv2.IMREAD_COLOR)
-            w, h = template.shape[1], template.shape[0]
-
-            method = cv2.TM_CCOEFF_NORMED
-            res = cv2.matchTemplate(src, template, method)
-            _, max_val, _, max_loc = cv2.minMaxLoc(res)
-
+                              show_value=False, show_position=True, show_only_true_rect=True, ms=2000, crop=[],
+                              new_frame=False):
+        key = (tuple(template_path_list), use_gray)
+        template_set = self._template_sets.get(key)
+        if template_set is None:
+            template_set = self.createTemplateSet(template_path_list, use_gray)
+            self._template_sets[key] = template_set
+
+        scores, locs = self.matchTemplateSet(template_set, crop, new_frame)
+        sizes = template_set.sizes(BASE_RESOLUTION)
+
+        for i, template_path in enumerate(template_path_list):
             if show_value:
-                print(template_path + ' ZNCC value: ' + str(max_val))
-
-            top_left = max_loc
-            bottom_right = (top_left[0] + w + 1, top_left[1] + h + 1)
-            tag = str(time.perf_counter()) + str(random.random())
-            max_val_list.append(max_val)
-            judge_threshold_list.append(max_val >= threshold)
-
-            if max_val >= threshold:
-                if self.gui is not None and show_position:
-                    # self.gui.delete("ImageRecRect")
-                    self.gui.ImgRect(*top_left,
-                                    *bottom_right,
-                                    outline='blue',
-                                    tag=tag,
-                                    ms=ms)
-            else:
-                if self.gui is not None and show_position and not show_only_true_rect:
-                    # self.gui.delete("ImageRecRect")
-                    self.gui.ImgRect(*top_left,
-                                    *bottom_right,
-                                    outline='red',
-                                    tag=tag,
-                                    ms=ms)
+                print(template_path + ' ZNCC value: ' + str(scores[i]))
+            self._showMatchRect(scores[i], threshold, (int(locs[i][0]), int(locs[i][1])),
+                                int(sizes[i][0]), int(sizes[i][1]), show_position, show_only_true_rect, ms)
 
-        return np.argmax(max_val_list), max_val_list, judge_threshold_list
+        return np.argmax(scores), scores.tolist(), (scores >= threshold).tolist()
 
     try:
         def isContainTemplateGPU(self, template_path, threshold=0.7, use_gray=True,
@@ -435,7 +654,7 @@ class ImageProcPythonCommand(PythonCommand):
 
             self.gsrc.upload(src)
 
-            template = cv2.imread(_get_template_filespec(template_path), cv2.IMREAD_GRAYSCALE if use_gray else cv2.IMREAD_COLOR)
+            template = self.loadTemplate(template_path, use_gray, (src.shape[1], src.shape[0]))
             self.gtmpl.upload(template)
 
             method = cv2.TM_CCOEFF_NORMED
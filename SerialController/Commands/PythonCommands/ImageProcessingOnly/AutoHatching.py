@@ -12,6 +12,7 @@ class AutoHatching(ImageProcPythonCommand):
 
     def __init__(self, cam):
         super().__init__(cam)
+        self.preloadTemplates(['egg_notice.png', 'egg_found.png', 'shiny_mark.png', 'status.png'])
         self.cam = cam
         self.party_num = 1  # don't count eggs
         self.hatched_num = 0
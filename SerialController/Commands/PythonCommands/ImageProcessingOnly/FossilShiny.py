@@ -8,6 +8,7 @@ from Commands.PythonCommandBase import ImageProcPythonCommand
 class Fossil_shiny(ImageProcPythonCommand):
     def __init__(self, cam):
         super().__init__(cam)
+        self.preloadTemplates(['Network_Offline.png', 'OP.png', 'shiny_mark.png', 'status.png'])
 
     '''
     head = {0 : "カセキのトリ", 1 : "カセキのサカナ"}
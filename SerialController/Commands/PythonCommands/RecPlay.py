@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from Commands.Keys import Direction, Stick
+from Commands.Keys import Direction, Stick, stickRow, stickXY
 from Commands.Keys import Button
 from Commands.PythonCommandBase import PythonCommand
+from StickTelemetry import readStickTelemetry
 from tkinter import filedialog
 import time
-import numpy as np
 
 
 # Mash a button A
@@ -29,20 +29,26 @@ class PlayRec(PythonCommand):
         self.checkIfAlive()
 
     def LStick(self, angle, r=1.0, duration=0.015):
-        self.keys.ser.writeRow(
-            f'2 8 {hex(int(128 + r * 127.5 * np.cos(np.deg2rad(angle))))} {hex(int(128 - r * 127.5 * np.sin(np.deg2rad(angle))))}'
-        )
+        self.keys.ser.writeRow(stickRow(left=stickXY(angle, r)))
         time.sleep(duration)
 
     def do(self):
-        file = filedialog.askopenfile(initialdir='~/')
-        self.log = file.name
+        self.log = filedialog.askopenfilename(initialdir='~/', filetypes=[('Input log', '*.trace *.stk *.log *.csv *.txt'), ('All', '*')])
         print(self.log)
-        with open(self.log) as f:
-            l_strip = [list(map(float, s.strip().split(","))) for s in f.readlines()]
-            # print(l_strip[:20])
-        for i in l_strip:
-            self.LStick(i[0], i[1], duration=i[2] * 1.0)
-            # self.wait(i[2]*0.90)
-
-        self.stickEnd(Direction(Stick.LEFT, 0, 0, showName=f'Angle={l_strip[0][0]},r={l_strip[0][1]}'))
+        if not self.log:
+            return
+        if self.log.endswith('.trace'):
+            self.playTrace(self.log)
+            return
+        if self.log.endswith('.stk'):
+            for angle, r, duration in readStickTelemetry(self.log):
+                self.LStick(angle, r, duration=duration)
+        else:
+            with open(self.log) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    angle, r, duration = map(float, line.strip().split(","))
+                    self.LStick(angle, r, duration=duration)
+
+        self.stickEnd(Direction(Stick.LEFT, 0, 0, showName='Angle=0,r=0'))
@@ -2,17 +2,295 @@
 # -*- coding: utf-8 -*-
 import math
 import os
+import threading
 import time
 import platform
+from collections import deque
 
 import serial
 from logging import getLogger, DEBUG, NullHandler
 
+from .Macro import REPORT_INTERVAL
+from .Trace import TraceRecorder
+
+# Binary frame: [SYNC] [btn_hi] [btn_lo] [hat] [v0] [v1] [v2] [v3] [checksum]
+# This format needs to be the same as the one written in Joystick.c
+BIN_SYNC = 0xA5
+BIN_ACK = b'OK BIN'
+
+# ファームウェアは起動時この速度で通信し、より速い速度は`end baud <rate>`で切り替える
+BASE_BAUDRATE = 9600
+# 新しい速度で確認が来なければファームウェアが基本の速度に戻るまでの時間(s)。Joystick.cのBAUD_CONFIRM_TIMEOUT_MSと同じ値にする
+BAUD_CONFIRM_TIMEOUT = 1.0
+
+# Joystick.cのMAX_BUFFERより長いテキスト行は切り詰められる
+MAX_ROW_LENGTH = 31
+
+
+def encodeBinaryRow(row):
+    """
+    テキスト形式の入力行(例: `0x0008 8 80 80`)をバイナリフレームに変換する
+
+    スティックの値は行と同じ並びのまま詰め、足りない分は中央値で埋める。
+
+    Returns:
+        bytes: 9バイトのフレーム
+    """
+    values = row.split(' ')
+    btn = int(values[0], 16)
+    payload = [btn >> 8 & 0xFF, btn & 0xFF, int(values[1], 16)]
+    payload += [int(v, 16) for v in values[2:6]]
+    payload += [0x80] * (7 - len(payload))
+    checksum = 0
+    for b in payload:
+        checksum ^= b
+    return bytes([BIN_SYNC] + payload + [checksum])
+
+
+def resolveRow(row, state=None):
+    """
+    入力行を適用した後のコントローラーの状態を求める
+
+    入力行は変化したスティックの値しか含まないので、直前の状態`state`に重ねて解釈する(Joystick.cと同じ規則)。
+
+    Returns:
+        tuple: (buttons, hat, lx, ly, rx, ry)。入力行でない場合はNone
+    """
+    if not row[:1].isdigit():
+        return None
+    values = row.split(' ')
+    btn = int(values[0], 16)
+    sticks = [int(v, 16) for v in values[2:6]]
+    lx, ly, rx, ry = state[2:] if state is not None else (0x80, 0x80, 0x80, 0x80)
+    if btn & 0x2:
+        lx, ly = sticks[0], sticks[1]
+    if btn & 0x1 and btn & 0x2:
+        rx, ry = sticks[2], sticks[3]
+    elif btn & 0x1:
+        rx, ry = sticks[0], sticks[1]
+    return btn >> 2, int(values[1], 16), lx, ly, rx, ry
+
+
+def formatState(state):
+    # 全てのスティックの値を含む入力行を作る
+    btn, hat, lx, ly, rx, ry = state
+    return f"{format(btn << 2 | 0x3, '#06x')} {hat} {lx:x} {ly:x} {rx:x} {ry:x}"
+
+
+def isReleaseState(state, before):
+    # ボタンが離されたか、HATが中央に戻ったか(押されたものがない)
+    if state is None or before is None:
+        return False
+    released = before[0] & ~state[0] or (state[1] == 8 and before[1] != 8)
+    return bool(released) and not state[0] & ~before[0]
+
+
+class EchoMonitor:
+    """
+    ファームウェアのエコーバックを送った行と突き合わせ、往復の遅延と欠落を調べるクラス
+
+    テキストの行はエコーが1行(`\\r`か`\\n`まで)そろってから、送った行と同じかどうかで突き合わせる。
+    ファームウェアの応答(`OK BIN`など)はエコーの`\\r`と`\\n`の間に入るので、突き合わない行は応答として`messages`に入れる。
+    バイナリのフレームは行末を持たないので、同じ長さのバイト列で突き合わせ、違っていれば`broken`として数える。
+    行末のエコーが返ってくるまでを往復の遅延とし、`timeout`秒以内に返ってこなかった行は`lost`として数える。
+    """
+
+    def __init__(self, timeout=1.0, history=1000):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._message_cond = threading.Condition(self._lock)
+        self._pending = deque()  # [data, echo, sent_at]
+        self._rtts = deque(maxlen=history)
+        self._line = bytearray()
+        # 受け取り途中のバイナリのフレームのエコー
+        self._frame = None
+        self.messages = deque(maxlen=32)
+        self.echoed = 0
+        self.broken = 0
+        self.lost = 0
+        self.truncated = 0
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+            self._line.clear()
+            self._frame = None
+            self.messages.clear()
+
+    def expect(self, data):
+        # 送り出した時刻は書き込み後に更新する
+        is_frame = data[:1] == bytes([BIN_SYNC])
+        entry = [data, data if is_frame else data.rstrip(b'\r\n'), time.perf_counter()]
+        with self._lock:
+            self._pending.append(entry)
+            if not is_frame and len(entry[1]) > MAX_ROW_LENGTH:
+                self.truncated += 1
+        return entry
+
+    def feed(self, received, now):
+        with self._lock:
+            for b in received:
+                self._feedByte(b, now)
+            # 期限までにエコーが返ってこなかった行
+            while self._pending and now - self._pending[0][2] > self.timeout:
+                self._pending.popleft()
+                self.lost += 1
+
+    def _feedByte(self, b, now):
+        if self._frame is not None:
+            self._frame.append(b)
+            if len(self._frame) == len(self._pending[0][1]):
+                self._matchFrame(bytes(self._frame), now)
+                self._frame = None
+            return
+        if not self._line and b == BIN_SYNC and self._pending and self._pending[0][0][:1] == bytes([BIN_SYNC]):
+            self._frame = bytearray([b])
+            return
+
+        if b not in (ord('\r'), ord('\n')):
+            self._line.append(b)
+            return
+        if not self._line:
+            return
+        line = bytes(self._line)
+        self._line.clear()
+        if not self._matchEcho(line, now):
+            self.messages.append(line.strip())
+            self._message_cond.notify_all()
+
+    def _matchEcho(self, echo, now):
+        # 先に送った行のエコーが返ってこなかった場合に備えて、後の行とも突き合わせる
+        for i, entry in enumerate(self._pending):
+            if entry[1] == echo:
+                for _ in range(i):
+                    self._pending.popleft()
+                    self.lost += 1
+                self._pending.popleft()
+                self.echoed += 1
+                self._rtts.append(now - entry[2])
+                return True
+        return False
+
+    def _matchFrame(self, echo, now):
+        if self._matchEcho(echo, now):
+            return
+        self._pending.popleft()
+        self.broken += 1
+
+    def clearMessages(self, ack):
+        with self._lock:
+            for message in [m for m in self.messages if ack in m]:
+                self.messages.remove(message)
+
+    def waitMessage(self, ack, timeout):
+        """
+        Returns:
+            bool: `ack`を含む応答を`timeout`秒以内に受け取ったか
+        """
+        deadline = time.perf_counter() + timeout
+        with self._message_cond:
+            while True:
+                for message in self.messages:
+                    if ack in message:
+                        self.messages.remove(message)
+                        return True
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self._message_cond.wait(remaining)
+
+    def stats(self):
+        """
+        Returns:
+            dict: 往復の遅延の中央値・99パーセンタイル(ms)と、エコーが返った・欠けた・返らなかった・切り詰められた行数
+        """
+        with self._lock:
+            rtts = sorted(self._rtts)
+            result = {'echoed': self.echoed, 'broken': self.broken, 'lost': self.lost, 'truncated': self.truncated}
+        if rtts:
+            result['p50_ms'] = rtts[int(0.5 * (len(rtts) - 1))] * 1000
+            result['p99_ms'] = rtts[int(0.99 * (len(rtts) - 1))] * 1000
+        else:
+            result['p50_ms'] = result['p99_ms'] = None
+        return result
+
+
+class WriteTicket:
+    """
+    書き込みキューに入れた1行の控え
+
+    `wait()`で実際にホストから送り出された時刻(time.perf_counter())を得られる。
+    送られずに破棄された場合は`dropped`がTrueになり、時刻はNoneになる。
+    """
+
+    def __init__(self, row, state=None, is_show=False, is_direct=False, can_merge=True):
+        self.row = row
+        self.state = state
+        self.is_show = is_show
+        self.is_direct = is_direct
+        # 送られるまでの間に、後の行の変化をまとめてよいか
+        self.can_merge = can_merge
+        # 直前の行からスティックだけが変化した行か
+        self.is_stick_only = False
+        self.queued_at = time.perf_counter()
+        self.sent_at = None
+        self.dropped = False
+        self._event = threading.Event()
+
+    def done(self, sent_at):
+        self.sent_at = sent_at
+        self.dropped = sent_at is None
+        self._event.set()
+
+    def isDone(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.sent_at
+
 
 class Sender:
-    def __init__(self, is_show_serial, if_print=True):
+    def __init__(self, is_show_serial, if_print=True, use_binary=False, use_hold=False):
         self.ser = None
         self.is_show_serial = is_show_serial
+        # バイナリ形式で送るか(接続時にファームウェアが応答した場合のみ有効になる)
+        self.use_binary = use_binary
+        self.is_binary = False
+        # ファームウェアが`hold`(押している時間をレポート数で数える)に対応しているか
+        self.has_hold = False
+        # 対応していれば、press()の押している時間をファームウェアに数えさせるか(設定のuse_mcu_hold)
+        self.use_hold = use_hold
+        # ファームウェアが`end <option>`に応答するか(応答しない古いファームウェアには以降の問い合わせを送らない)
+        self.has_protocol = False
+
+        # 冗長な入力行を送らず、スティックだけの変化は`coalesce_interval`秒の間まとめて送る
+        self.coalesce_interval = REPORT_INTERVAL
+        self.saved_writes = 0
+        self._write_lock = threading.RLock()
+        self._sent_state = None
+        self._state = None
+        self._pending = False
+        # まとめ待ちの行を送る時刻(time.perf_counter())。書き込みスレッドが送る
+        self._flush_at = None
+        self._last_write = 0.0
+
+        # ポートへの書き込みは専用のスレッドだけが行う
+        self.queue_size = 64
+        # キューが満杯のとき、コマンドのスレッドが空くのを待つ秒数(GUIのスレッドは待たない)
+        self.put_timeout = 0.5
+        self._queue = deque()
+        self._queue_cond = threading.Condition()
+        self._writer_thread = None
+        self._writer_stop = False
+
+        # エコーバックを読むスレッド
+        self.echo_monitor = EchoMonitor()
+        self._reader_thread = None
+        self._reader_stop = False
+
+        # 入力の記録(Trace.TraceRecorder)
+        self.recorder = None
 
         self._logger = getLogger(__name__)
         self._logger.addHandler(NullHandler())
@@ -41,56 +319,485 @@ class Sender:
                     "CENTER"]
 
     def openSerial(self, portNum: int, portName: str = '', baudrate: int = 9600):
+        # 高速な通信速度は接続後にファームウェアと取り決める
+        open_rate = min(int(baudrate), BASE_BAUDRATE)
         try:
             if portName is None or portName == '':
                 if os.name == 'nt':
                     print('connecting to ' + "COM" + str(portNum) + "(" + str(baudrate) + ")")
                     self._logger.info('connecting to ' + "COM" + str(portNum) + "(" + str(baudrate) + ")")
-                    self.ser = serial.Serial("COM" + str(portNum), baudrate)
-                    return True
+                    self.ser = serial.Serial("COM" + str(portNum), open_rate)
+                    return self.setupProtocol(baudrate)
                 elif os.name == 'posix':
                     if platform.system() == 'Darwin':
                         print('connecting to ' + "/dev/tty.usbserial-" + str(portNum) + "(" + str(baudrate) + ")")
                         self._logger.info('connecting to ' + "/dev/tty.usbserial-" + str(portNum) + "(" + str(baudrate) + ")")
-                        self.ser = serial.Serial("/dev/tty.usbserial-" + str(portNum), baudrate)
-                        return True
+                        self.ser = serial.Serial("/dev/tty.usbserial-" + str(portNum), open_rate)
+                        return self.setupProtocol(baudrate)
                     else:
                         print('connecting to ' + "/dev/ttyUSB" + str(portNum) + "(" + str(baudrate) + ")")
                         self._logger.info('connecting to ' + "/dev/ttyUSB" + str(portNum) + "(" + str(baudrate) + ")")
-                        self.ser = serial.Serial("/dev/ttyUSB" + str(portNum), baudrate)
-                        return True
+                        self.ser = serial.Serial("/dev/ttyUSB" + str(portNum), open_rate)
+                        return self.setupProtocol(baudrate)
                 else:
                     print('Not supported OS')
                     self._logger.warning('Not supported OS')
                     return False
             else:
-                print('connecting to ' + portName)
-                self._logger.info('connecting to ' + portName)
-                self.ser = serial.Serial(portName, 9600)
-                return True
+                print('connecting to ' + portName + "(" + str(baudrate) + ")")
+                self._logger.info('connecting to ' + portName + "(" + str(baudrate) + ")")
+                self.ser = serial.Serial(portName, open_rate)
+                return self.setupProtocol(baudrate)
         except IOError as e:
             print('COM Port: can\'t be established')
             self._logger.error('COM Port: can\'t be established', e)
             # print(e)
             return False
 
+    def setupProtocol(self, baudrate=BASE_BAUDRATE):
+        self.is_binary = False
+        self.has_hold = False
+        self.has_protocol = self.probeFirmware()
+        if not self.has_protocol:
+            # 古いファームウェアは基本の速度・テキスト形式のまま使う
+            print(f'Firmware does not answer protocol requests. Using {BASE_BAUDRATE} baud text rows')
+            self._logger.info(f'Firmware does not answer protocol requests. Using {BASE_BAUDRATE} baud text rows')
+            self.startWriter()
+            self.startReader()
+            return True
+
+        if int(baudrate) > BASE_BAUDRATE:
+            self.negotiateBaudRate(int(baudrate))
+        if self.use_binary:
+            self.is_binary = self.negotiate('end binary', BIN_ACK)
+            if self.is_binary:
+                print('Binary serial protocol enabled')
+                self._logger.info('Binary serial protocol enabled')
+            else:
+                self._logger.info('Firmware does not support the binary protocol. Using text rows')
+        self.has_hold = self.negotiate('end hold', b'OK HOLD')
+        self._logger.debug(f"Firmware timed hold: {'supported' if self.has_hold else 'not supported'}")
+        self.startWriter()
+        self.startReader()
+        return True
+
+    def isReaderRunning(self):
+        return self._reader_thread is not None and self._reader_thread.is_alive()
+
+    def startReader(self):
+        if self.isReaderRunning():
+            return
+        # 止められるように読み込みにタイムアウトを設ける
+        self.ser.timeout = 0.05
+        self.echo_monitor.reset()
+        self._reader_stop = False
+        self._reader_thread = threading.Thread(target=self._readLoop, name="SerialReader", daemon=True)
+        self._reader_thread.start()
+        self._logger.debug("Serial reader thread started")
+
+    def stopReader(self, timeout=1.0):
+        if not self.isReaderRunning():
+            return
+        self._reader_stop = True
+        self._reader_thread.join(timeout)
+        self._reader_thread = None
+        self._logger.debug("Serial reader thread stopped")
+
+    def _readLoop(self):
+        while not self._reader_stop:
+            try:
+                received = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.serialutil.SerialException, OSError, TypeError) as e:
+                self._logger.debug(f"Serial reader stopped: {e}")
+                return
+            self.echo_monitor.feed(received, time.perf_counter())
+
+    def latencyStats(self):
+        """
+        Returns:
+            dict: ホストからMCUまでの往復の遅延と、欠落した行の数(EchoMonitor.stats()を参照)
+        """
+        return self.echo_monitor.stats()
+
+    def isWriterRunning(self):
+        return self._writer_thread is not None and self._writer_thread.is_alive()
+
+    def startWriter(self):
+        if self.isWriterRunning():
+            return
+        self._writer_stop = False
+        self._writer_thread = threading.Thread(target=self._writeLoop, name="SerialWriter", daemon=True)
+        self._writer_thread.start()
+        self._logger.debug("Serial writer thread started")
+
+    def stopWriter(self, timeout=1.0):
+        # キューに残った行を送り終えてから止める
+        if not self.isWriterRunning():
+            return
+        with self._queue_cond:
+            self._writer_stop = True
+            self._queue_cond.notify_all()
+        self._writer_thread.join(timeout)
+        self._writer_thread = None
+        self._logger.debug("Serial writer thread stopped")
+
+    def _writeLoop(self):
+        while True:
+            with self._queue_cond:
+                ticket = None
+                while not self._queue and not self._writer_stop:
+                    flush_at = self._flush_at
+                    if flush_at is None:
+                        self._queue_cond.wait()
+                        continue
+                    remaining = flush_at - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._queue_cond.wait(remaining)
+                if self._queue:
+                    ticket = self._queue.popleft()
+                    self._queue_cond.notify_all()
+                elif self._writer_stop:
+                    return
+            if ticket is None:
+                # まとめ待ちの行を送る時刻になった(_write_lockを取るので_queue_condの外で呼ぶ)
+                self.flush()
+                continue
+            self._sendTicket(ticket)
+
+    def _sendTicket(self, ticket):
+        if ticket.is_direct:
+            ticket.done(self._writeDirect(ticket.row))
+        else:
+            ticket.done(self._writeSerial(ticket.row, ticket.is_show))
+            if ticket.dropped and ticket.state is not None:
+                # 書き込めなかった状態はファームウェアに届いていないので、次の入力行は必ず送る
+                with self._write_lock:
+                    self._sent_state = None
+
+    def _enqueue(self, ticket):
+        if not self.isWriterRunning():
+            self._sendTicket(ticket)
+            return ticket
+
+        with self._queue_cond:
+            last = self._queue[-1] if self._queue else None
+            if ticket.row == 'end' or ticket.row.startswith('end '):
+                # endは待っている行を全て追い越す
+                self._dropQueued(lambda t: True)
+            elif (ticket.state is not None and ticket.can_merge and last is not None and last.state is not None
+                  and not last.is_direct and last.can_merge):
+                if last.state[:2] == ticket.state[:2]:
+                    # まだ送られていない直前の行に、スティックだけの変化をまとめる
+                    last.row = formatState(ticket.state)
+                    last.state = ticket.state
+                    self.saved_writes += 1
+                    return last
+                if isReleaseState(ticket.state, last.state):
+                    # 離す操作は、待っているスティックだけの行を追い越す(全ての値を含む行で送る)
+                    if self._dropQueued(lambda t: t.is_stick_only):
+                        ticket.row = formatState(ticket.state)
+            elif ticket.state is not None and last is None and self._sent_state is not None:
+                ticket.is_stick_only = self._sent_state[:2] == ticket.state[:2]
+
+            if len(self._queue) >= self.queue_size and threading.current_thread() is threading.main_thread():
+                # GUIのスレッドは待たせず、一番古い入力行を捨てて空ける
+                oldest = next((t for t in self._queue if t.state is not None and not t.is_direct), None)
+                if oldest is None:
+                    self._logger.warning(f"Serial write queue is full. Dropped: {ticket.row}")
+                    ticket.done(None)
+                    return ticket
+                self._queue.remove(oldest)
+                oldest.done(None)
+                self._logger.warning(f"Serial write queue is full. Dropped: {oldest.row}")
+
+            deadline = time.perf_counter() + self.put_timeout
+            while len(self._queue) >= self.queue_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not self._queue_cond.wait(remaining):
+                    # 呼び出し側はticket.droppedを見て、この状態を送信済みとして扱わない
+                    self._logger.warning(f"Serial write queue is full. Dropped: {ticket.row}")
+                    ticket.done(None)
+                    return ticket
+            self._queue.append(ticket)
+            self._queue_cond.notify_all()
+        return ticket
+
+    def _dropQueued(self, predicate):
+        kept = deque()
+        dropped = 0
+        for t in self._queue:
+            if predicate(t):
+                t.done(None)
+                dropped += 1
+            else:
+                kept.append(t)
+        self._queue = kept
+        self.saved_writes += dropped
+        return dropped
+
+    def negotiate(self, row, ack, timeout=0.3):
+        """
+        コマンドを送り、ファームウェアからの応答を待つ
+
+        応答を返さない古いファームウェアでも無害なよう、コマンドは`end <option>`の形で送る。
+
+        Returns:
+            bool: `ack`を受け取ったか
+        """
+        if self.isReaderRunning():
+            # 受信は読み込みスレッドが行っているので、応答が届くのを待つ
+            self.writeRow_wo_perf_counter(row)
+            return self.echo_monitor.waitMessage(ack, timeout)
+        try:
+            self.ser.reset_input_buffer()
+            self.ser.write((row + '\r\n').encode('utf-8'))
+            received = b''
+            deadline = time.perf_counter() + timeout
+            while time.perf_counter() < deadline:
+                # エコーバックも含めて読み、応答が含まれているかを見る
+                if self.ser.in_waiting:
+                    received += self.ser.read(self.ser.in_waiting)
+                    if ack in received:
+                        return True
+                time.sleep(0.005)
+        except serial.serialutil.SerialException as e:
+            self._logger.error(f"Error : {e}")
+        return False
+
+    def probeFirmware(self):
+        """
+        ファームウェアが`end <option>`の問い合わせに応答するかを調べる
+
+        前回の接続の速度のままになっているファームウェアは、基本の速度で送った`end`を読めずに基本の速度へ戻る。
+        古いファームウェアには`end`(リセット)として届くだけなので、問い合わせは1回だけ送る。
+
+        Returns:
+            bool: 応答があったか
+        """
+        try:
+            self.ser.write(b'end\r\n')
+            time.sleep(0.02)
+            self.ser.reset_input_buffer()
+        except serial.serialutil.SerialException as e:
+            self._logger.error(f"Error : {e}")
+            return False
+        return self.negotiate(f'end baud {BASE_BAUDRATE}', f'OK BAUD {BASE_BAUDRATE}'.encode('utf-8'))
+
+    def negotiateBaudRate(self, baudrate, retry=2, fallback_wait=BAUD_CONFIRM_TIMEOUT + 0.2):
+        """
+        ファームウェアと通信速度を取り決める
+
+        基本の速度で`end baud <rate>`を送り、応答があれば新しい速度に切り替えて同じコマンドで疎通を確認する。
+        確認できなければ基本の速度に戻す(ファームウェアも確認が来なければ`BAUD_CONFIRM_TIMEOUT`秒で基本の速度に戻る)。
+
+        Returns:
+            bool: 新しい速度に切り替えられたか
+        """
+        row = f'end baud {baudrate}'
+        ack = f'OK BAUD {baudrate}'.encode('utf-8')
+        if not self.negotiate(row, ack):
+            print(f'Firmware does not support {baudrate} baud. Using {BASE_BAUDRATE} baud')
+            self._logger.warning(f'Firmware does not support {baudrate} baud. Using {BASE_BAUDRATE} baud')
+            return False
+
+        # 応答を送り終えてからファームウェアが切り替えるので少し待つ
+        time.sleep(0.02)
+        self.ser.baudrate = baudrate
+        for _ in range(retry):
+            if self.negotiate(row, ack):
+                print(f'Serial baud rate: {baudrate}')
+                self._logger.info(f'Serial baud rate: {baudrate}')
+                return True
+
+        print(f'Link at {baudrate} baud is unreliable. Falling back to {BASE_BAUDRATE} baud')
+        self._logger.warning(f'Link at {baudrate} baud is unreliable. Falling back to {BASE_BAUDRATE} baud')
+        self.ser.baudrate = BASE_BAUDRATE
+        time.sleep(fallback_wait)
+        self.ser.reset_input_buffer()
+        return False
+
+    def uploadMacro(self, sequence, timeout=2.0):
+        """
+        入力の並び(Macro.MacroSequence)をMCUのRAMに送る
+
+        Returns:
+            bool: MCUが全てのステップを受け取ったか
+        """
+        rows = sequence.toRows()
+        if not self.has_protocol:
+            print('Firmware does not support macros')
+            self._logger.warning('Firmware does not support macros')
+            return False
+        if not self.isReaderRunning():
+            self._logger.error('Cannot upload a macro without the serial reader')
+            return False
+        if not self.negotiate(f'end macro {len(sequence)}', f'OK MACRO {len(sequence)}'.encode('utf-8')):
+            print('Firmware does not support macros')
+            self._logger.warning('Firmware does not support macros')
+            return False
+        for row in rows:
+            self.writeRow_wo_perf_counter(row)
+        if not self.echo_monitor.waitMessage(f'OK LOADED {len(sequence)}'.encode('utf-8'), timeout):
+            self._logger.warning('Failed to upload a macro')
+            return False
+        self._logger.debug(f'Uploaded a macro ({len(sequence)} steps, {len(rows)} rows)')
+        return True
+
+    def runMacro(self, repeat=1):
+        # repeatが0の場合はendを送るまで繰り返す
+        self.echo_monitor.clearMessages(b'OK DONE')
+        return self.writeRow_wo_perf_counter(f'mrun {int(repeat)}')
+
+    def waitMacro(self, timeout):
+        """
+        Returns:
+            bool: `timeout`秒以内にマクロの実行が終わったか
+        """
+        return self.echo_monitor.waitMessage(b'OK DONE', timeout)
+
+    def isRecording(self):
+        return self.recorder is not None
+
+    def startRecording(self, path):
+        # 以降の状態の変化を`path`に記録する
+        with self._write_lock:
+            self.stopRecording()
+            self.recorder = TraceRecorder(path)
+            if self._state is not None:
+                self.recorder.record(self._state)
+
+    def stopRecording(self):
+        with self._write_lock:
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+
+    def encodeRow(self, row):
+        if self.is_binary and row[:1].isdigit():
+            return encodeBinaryRow(row)
+        return (row + '\r\n').encode('utf-8')
+
+    def restoreBaudRate(self):
+        # 次の接続(アプリの再起動を含む)が基本の速度で始められるよう、ファームウェアを基本の速度に戻す
+        if self.ser is None or not self.ser.isOpen() or self.ser.baudrate == BASE_BAUDRATE:
+            return True
+        is_restored = self.negotiate(f'end baud {BASE_BAUDRATE}', f'OK BAUD {BASE_BAUDRATE}'.encode('utf-8'))
+        if not is_restored:
+            self._logger.warning(f'Failed to restore {BASE_BAUDRATE} baud on the firmware')
+        self.ser.baudrate = BASE_BAUDRATE
+        return is_restored
+
     def closeSerial(self):
         self._logger.debug("Closing the serial communication")
+        self.is_binary = False
+        with self._write_lock:
+            self._cancelPending()
+            self._state = self._sent_state = None
+        self.restoreBaudRate()
+        self.stopWriter()
+        self.stopReader()
         self.ser.close()
 
     def isOpened(self):
         self._logger.debug("Checking if serial communication is open")
         return True if self.ser is not None and self.ser.isOpen() else False
 
-    def writeRow(self, row, is_show=False):
+    def writeRow(self, row, is_show=False, coalesce=True):
+        # coalesceがFalseの場合は、スティックだけの変化もまとめずにすぐ送る(記録した入力の再生など)
+        with self._write_lock:
+            state = resolveRow(row, self._state)
+            if state is None:
+                # 入力行以外(endなど)の後はファームウェアの状態がわからないので、次は必ず送る
+                self._cancelPending()
+                self._state = self._sent_state = None
+                if row == 'end' and self.saved_writes:
+                    self._logger.debug(f"Saved {self.saved_writes} serial writes by coalescing")
+                if row == 'end' and self.isReaderRunning():
+                    self._logger.debug(f"Serial latency: {self.latencyStats()}")
+                return self._writeRow(row, is_show)
+
+            if self.recorder is not None and state != self._state:
+                self.recorder.record(state)
+            self._state = state
+            if state == self._sent_state:
+                # 送信済みの状態と同じなので送らない
+                self.saved_writes += 1
+                self._cancelPending()
+                return None
+
+            if (coalesce and self._sent_state is not None and state[:2] == self._sent_state[:2]
+                    and self.isWriterRunning() and time.perf_counter() - self._last_write < self.coalesce_interval):
+                # スティックだけの変化は、直前の送信から1レポート間隔が経つまで待ってまとめる(書き込みスレッドが送る)
+                if self._pending:
+                    self.saved_writes += 1
+                else:
+                    self._pending = True
+                    with self._queue_cond:
+                        self._flush_at = self._last_write + self.coalesce_interval
+                        self._queue_cond.notify_all()
+                return None
+
+            if self._pending:
+                # まとめ待ちの変化を含めるため、全ての値を含む行で送る
+                self._cancelPending()
+                row = formatState(state)
+            ticket = self._writeRow(row, is_show, state, can_merge=coalesce)
+            self._sent_state = None if ticket.dropped else state
+            return ticket
+
+    def writeHold(self, row, reports, release_row):
+        """
+        `row`の入力を`reports`回のレポートの間続け、その後ファームウェアが元の入力に戻す
+
+        Args:
+            release_row (str): 戻した後の状態を表す入力行(送りはしない)
+        """
+        with self._write_lock:
+            self._cancelPending()
+            state = resolveRow(row, self._state)
+            ticket = self._writeRow(f'hold {int(reports):x} {row}', False)
+            self._state = resolveRow(release_row, state)
+            self._sent_state = None if ticket.dropped else self._state
+            if self.recorder is not None:
+                self.recorder.record(state)
+                self.recorder.record(self._state, delay=int(reports) * REPORT_INTERVAL)
+            return ticket
+
+    def flush(self):
+        # まとめ待ちの入力行を送る
+        with self._write_lock:
+            self._flush_at = None
+            if not self._pending:
+                return
+            self._pending = False
+            ticket = self._writeRow(formatState(self._state), False, self._state)
+            self._sent_state = None if ticket.dropped else self._state
+
+    def _cancelPending(self):
+        self._flush_at = None
+        if self._pending:
+            self._pending = False
+            self.saved_writes += 1
+
+    def _writeRow(self, row, is_show=False, state=None, can_merge=True):
+        self._last_write = time.perf_counter()
+        return self._enqueue(WriteTicket(row, state, is_show, can_merge=can_merge))
+
+    def _writeSerial(self, row, is_show=False):
+        sent_at = None
         try:
             self.time_bef = time.perf_counter()
             if self.before is not None and self.before != 'end' and is_show:
                 output = self.before.split(' ')
                 self.show_input(output)
 
-            self.ser.write((row + '\r\n').encode('utf-8'))
-            self.time_aft = time.perf_counter()
+            data = self.encodeRow(row)
+            echo = self.echo_monitor.expect(data) if self.isReaderRunning() else None
+            self.ser.write(data)
+            self.time_aft = sent_at = time.perf_counter()
+            if echo is not None:
+                echo[2] = sent_at
             self.before = row
         except serial.serialutil.SerialException as e:
             # print(e)
@@ -103,10 +810,24 @@ class Sender:
         # Show sending serial datas
         if self.is_show_serial.get():
             print(row)
+        return sent_at
     
     def writeRow_wo_perf_counter(self, row, is_show=False):
+        with self._write_lock:
+            # 直接送った行の後はファームウェアの状態がわからないので、次の入力行は必ず送る
+            self._cancelPending()
+            self._state = self._sent_state = None
+        return self._enqueue(WriteTicket(row, is_direct=True))
+
+    def _writeDirect(self, row):
+        sent_at = None
         try:
-            self.ser.write((row + '\r\n').encode('utf-8'))
+            data = self.encodeRow(row)
+            echo = self.echo_monitor.expect(data) if self.isReaderRunning() else None
+            self.ser.write(data)
+            sent_at = time.perf_counter()
+            if echo is not None:
+                echo[2] = sent_at
         except serial.serialutil.SerialException as e:
             # エラーはあえてprintでも出す。
             print(e)
@@ -119,6 +840,7 @@ class Sender:
         # Show sending serial datas
         if self.is_show_serial.get():
             print(row)
+        return sent_at
 
     def show_input(self, output):
         try:
@@ -4,8 +4,7 @@
 from time import sleep
 
 from . import CommandBase
-import numpy as np
-from .Keys import Button, Hat, KeyPress, Direction, Stick
+from .Keys import Button, Hat, KeyPress, Direction, Stick, stickRow, stickXY
 
 from logging import Formatter, handlers, StreamHandler, getLogger, DEBUG
 
@@ -61,10 +60,7 @@ class StickLeft(StickCommand):
         self._logger.debug("Start RightStick Serial Connection")
 
     def LStick(self, angle, r=1.0, duration=0.015):
-        self.ser.writeRow(
-            f'3 8 {hex(int(128 + r * 127.5 * np.cos(np.deg2rad(angle))))} {hex(int(128 - r * 127.5 * np.sin(np.deg2rad(angle))))} 80 80',
-            is_show=False
-        )
+        self.ser.writeRow(stickRow(left=stickXY(angle, r), right=(0x80, 0x80)), is_show=False)
         # self.stick(Direction(Stick.LEFT, angle, r, showName=f'Angle={angle},r={r}'), duration=duration, wait=0)
 
     def end(self, ser):
@@ -84,10 +80,7 @@ class StickRight(StickCommand):
         self._logger.debug("Start RightStick Serial Connection")
 
     def RStick(self, angle, r=1.0, duration=0.015):
-        self.key.ser.writeRow(
-            f'3 8 80 80 {hex(int(128 + r * 127.5 * np.cos(np.deg2rad(angle))))} {hex(int(128 - r * 127.5 * np.sin(np.deg2rad(angle))))}',
-            is_show=False
-        )
+        self.key.ser.writeRow(stickRow(left=(0x80, 0x80), right=stickXY(angle, r)), is_show=False)
 
     def end(self, ser):
         super().end(ser)
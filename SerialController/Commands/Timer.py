@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from logging import getLogger, DEBUG, NullHandler
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
+
+class PreciseTimer:
+    """
+    粗いsleepと最後だけのスピンを組み合わせた待機タイマー
+
+    期限の`margin`秒前まではtime.sleepで眠り、残りはtime.sleep(0)でGILを譲りながら待つ。
+    sleepの寝過ごし量を観測して`margin`を調整するため、OSのタイマー分解能(Windowsでは約15ms)に追従する。
+    待機ごとの誤差(期限からの遅れ)を集計し、`stats()`で参照できる。
+
+    Args:
+        min_margin (float): スピンで待つ最小の時間(s)
+        max_margin (float): スピンで待つ最大の時間(s)
+    """
+
+    def __init__(self, min_margin=0.0005, max_margin=0.02):
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+        self.margin = 0.002
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_drift = 0.0
+        self.max_drift = 0.0
+        self.spin_time = 0.0
+
+    def sleepUntil(self, deadline):
+        """
+        time.perf_counter()の時刻`deadline`まで待つ
+
+        Returns:
+            float: 期限からの遅れ(s)
+        """
+        remaining = deadline - time.perf_counter()
+        coarse = remaining - self.margin
+        if coarse > 0:
+            before = time.perf_counter()
+            time.sleep(coarse)
+            oversleep = time.perf_counter() - before - coarse
+            # 寝過ごしが大きければすぐ広げ、小さければゆっくり縮める
+            if oversleep > self.margin:
+                self.margin = min(self.max_margin, oversleep * 1.25)
+            else:
+                self.margin = max(self.min_margin, self.margin * 0.95 + oversleep * 0.05)
+
+        spin_start = time.perf_counter()
+        now = spin_start
+        while now < deadline:
+            time.sleep(0)
+            now = time.perf_counter()
+        self.spin_time += now - spin_start
+
+        drift = now - deadline
+        self.count += 1
+        self.total_drift += drift
+        if drift > self.max_drift:
+            self.max_drift = drift
+        return drift
+
+    def sleep(self, duration):
+        return self.sleepUntil(time.perf_counter() + max(0.0, float(duration)))
+
+    def stats(self):
+        """
+        Returns:
+            dict: 待機回数、平均・最大の遅れ(ms)、スピンに費やした合計時間(s)
+        """
+        return {
+            'count': self.count,
+            'mean_drift_ms': self.total_drift / self.count * 1000 if self.count else 0.0,
+            'max_drift_ms': self.max_drift * 1000,
+            'spin_time': self.spin_time,
+        }
+
+    def logStats(self):
+        if self.count == 0:
+            return
+        s = self.stats()
+        logger.debug(f"Timer: {s['count']} waits, mean drift {s['mean_drift_ms']:.3f} ms, "
+                     f"max drift {s['max_drift_ms']:.3f} ms, spin {s['spin_time']:.3f} s")
+
+
+class InputTimeline:
+    """
+    入力の押下・解放を、シーケンス開始時刻からの絶対的な期限に合わせて行うためのタイムライン
+
+    相対的な待機を繰り返すと、シリアル書き込みや処理のオーバーヘッドが1回ごとに積み重なってずれていく。
+    このクラスでは待機時間を期限に積算し、期限まで待つことでずれを次の待機で吸収する。
+    ただし`resync`秒以上遅れた場合(画像処理を挟んだ場合など)は、押下時間が縮まないよう現在時刻を基準に取り直す。
+
+    Args:
+        timer (PreciseTimer): 待機に使うタイマー
+        resync (float): 基準を取り直す遅れ(s)
+    """
+
+    # 遅れのヒストグラムの区切り(ms)
+    BUCKETS = (0.5, 1, 2, 5, 10, 20, 50)
+
+    def __init__(self, timer, resync=0.1):
+        self.timer = timer
+        self.resync = resync
+        self.start = time.perf_counter()
+        self.deadline = self.start
+        self.count = 0
+        self.resync_count = 0
+        self.max_lateness = 0.0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def wait(self, duration):
+        self.deadline += max(0.0, float(duration))
+        now = time.perf_counter()
+        if now - self.deadline > self.resync:
+            self.resync_count += 1
+            self.deadline = now + max(0.0, float(duration))
+        lateness = self.timer.sleepUntil(self.deadline)
+        self._record(lateness)
+        return lateness
+
+    def _record(self, lateness):
+        self.count += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        lateness_ms = lateness * 1000
+        for i, edge in enumerate(self.BUCKETS):
+            if lateness_ms < edge:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def report(self):
+        """
+        Returns:
+            str: 遅れのヒストグラムを表す文字列
+        """
+        labels = [f"<{edge}ms" for edge in self.BUCKETS] + [f">={self.BUCKETS[-1]}ms"]
+        hist = ", ".join(f"{label}: {n}" for label, n in zip(labels, self.histogram) if n)
+        return (f"{self.count} events in {time.perf_counter() - self.start:.3f} s, "
+                f"max lateness {self.max_lateness * 1000:.3f} ms, resync {self.resync_count} ({hist})")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+import threading
+import time
+from logging import getLogger, DEBUG, NullHandler
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
+TRACE_MAGIC = b'PCTRACE1'
+TRACE_VERSION = 1
+# magic, version, record size, 記録開始時刻(UNIX時間のns)
+HEADER = struct.Struct('<8sHHq')
+# 記録開始からの経過時間(ns), buttons, hat, lx, ly, rx, ry (16バイトに揃える)
+RECORD = struct.Struct('<QHBBBBBx')
+NEUTRAL_STATE = (0, 8, 0x80, 0x80, 0x80, 0x80)
+
+
+class TraceRecorder:
+    """
+    コントローラーの状態の変化を、時刻付きの固定長レコードとしてファイルに追記するクラス
+
+    状態はSender.resolveRowと同じ (buttons, hat, lx, ly, rx, ry) のタプルで渡す。
+    時刻はtime.perf_counter_nsで取るため、時計の補正の影響を受けない。
+    書きかけで終了した末尾のレコードは、読み込み時に無視される。
+
+    Args:
+        path (str): 記録するファイルのパス
+    """
+
+    def __init__(self, path, buffer_size=64 * 1024):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD.size, time.time_ns()))
+        self._start_ns = time.perf_counter_ns()
+        self._last_ns = 0
+        logger.debug(f"Start recording inputs: {path}")
+
+    def record(self, state, delay=0.0):
+        """
+        Args:
+            state (tuple): (buttons, hat, lx, ly, rx, ry)
+            delay (float): 現在時刻から遅らせて記録する時間(s)。ファームウェアが時間を数える入力用
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            t = time.perf_counter_ns() - self._start_ns + int(delay * 1e9)
+            # 時刻は必ず単調に増やす
+            t = self._last_ns if t < self._last_ns else t
+            self._file.write(RECORD.pack(t, *state))
+            self._last_ns = t
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        logger.debug(f"Recorded {self.count} inputs in {self._last_ns / 1e9:.3f} s: {self.path}")
+
+
+class TraceReader:
+    """
+    TraceRecorderで記録したファイルをメモリマップして読むクラス
+
+    ファイル全体を読み込まず、反復するたびにレコードを1つずつ取り出す。
+
+        with TraceReader(path) as trace:
+            for t_ns, state in trace:
+                ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"Empty trace file: {path}")
+        if len(self._mm) < HEADER.size:
+            self.close()
+            raise ValueError(f"Not a trace file: {path}")
+        magic, version, record_size, self.started_at = HEADER.unpack_from(self._mm, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"Unsupported trace file: {path}")
+        self._count = (len(self._mm) - HEADER.size) // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not -self._count <= index < self._count:
+            raise IndexError(index)
+        t, *state = RECORD.unpack_from(self._mm, HEADER.size + (index % self._count) * RECORD.size)
+        return t, tuple(state)
+
+    def __iter__(self):
+        mm = self._mm
+        for offset in range(HEADER.size, HEADER.size + self._count * RECORD.size, RECORD.size):
+            t, *state = RECORD.unpack_from(mm, offset)
+            yield t, tuple(state)
+
+    def duration(self):
+        # 最後の入力までの時間(s)
+        return self[-1][0] / 1e9 if self._count else 0.0
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+def defaultTracePath(directory="log"):
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, time.strftime("input_%Y%m%d_%H%M%S") + ".trace")
@@ -3,22 +3,23 @@
 
 import cv2
 import os
+import threading
 import time
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 import numpy as np
 import datetime
-from collections import deque
 
 from PIL import Image, ImageTk
 
+from Camera import BASE_RESOLUTION
 from Commands import UnitCommand
 from Commands import StickCommand
-from Commands.Keys import Direction, Stick, Button, Direction, KeyPress
+from Commands.Keys import Direction, Stick, Button, Direction, KeyPress, stickRow, stickXY
 
-import logging
 from logging import INFO, StreamHandler, getLogger, DEBUG, NullHandler
 from Commands.PythonCommandBase import PythonCommand, StopThread
+from StickTelemetry import StickTelemetryWriter
 
 try:
     os.makedirs('log')
@@ -55,6 +56,98 @@ class MouseStick(PythonCommand):
         self.keys.inputEnd(buttons)
 
 
+class PreviewRenderer:
+    """
+    プレビュー用の画像を別スレッドで作るクラス
+
+    フレームの読み込み、表示サイズへの縮小(cv2.INTER_AREA)、RGBへの変換をTkのスレッドの外で行い、
+    Tk側は`take`で受け取った画像を貼り替えるだけにする。`paused`の間は何もしない。
+    """
+
+    def __init__(self, camera, show_size, interval):
+        self.camera = camera
+        self.show_size = show_size
+        self.interval = interval
+        self.paused = False
+        self.rendered = 0
+
+        self._lock = threading.Lock()
+        self._image = None
+        self._is_new = False
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._thread = None
+
+        self._logger = getLogger(__name__)
+        self._logger.addHandler(NullHandler())
+        self._logger.setLevel(DEBUG)
+        self._logger.propagate = True
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="PreviewRenderer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def setPaused(self, paused):
+        if self.paused and not paused:
+            self._wakeup.set()
+        self.paused = paused
+
+    def take(self):
+        """
+        Returns:
+            tuple: (is_new, image) 前回から新しく作った画像があるか、と表示用のPIL画像(読み込めない場合はNone)
+        """
+        with self._lock:
+            is_new, self._is_new = self._is_new, False
+            return is_new, self._image
+
+    def _run(self):
+        frame_id = 0
+        while not self._stop:
+            if self.paused:
+                self._wakeup.wait(0.2)
+                self._wakeup.clear()
+                continue
+            start = time.perf_counter()
+            try:
+                if self.camera.camera is None:
+                    frame = None
+                elif self.camera.isCaptureThreadRunning():
+                    frame = self.camera.getFrame(frame_id, timeout=self.interval)
+                else:
+                    frame = self.camera.getFrame()
+                if frame is not None:
+                    frame_id = frame.frame_id
+                image = self._render(frame)
+            except (cv2.error, AttributeError) as e:
+                # カメラの開き直しの途中など
+                self._logger.debug(f"Failed to render a preview: {e}")
+                image = None
+            with self._lock:
+                self._image = image
+                self._is_new = True
+            self.rendered += 1
+            # Tk側の表示間隔より速く作っても捨てられるだけなので合わせる
+            self._wakeup.wait(max(0.0, self.interval - (time.perf_counter() - start)))
+            self._wakeup.clear()
+
+    def _render(self, frame):
+        # 縮小・変換した画像はFrameに残るので、同じフレームを使うコマンド側とも共有される
+        if frame is None:
+            return None
+        return Image.fromarray(frame.rgb(self.show_size))
+
+
 class CaptureArea(tk.Canvas):
     def __init__(self, camera, fps, is_show, ser, master=None, show_width=640, show_height=360):
         super().__init__(master, borderwidth=0, cursor='tcross', width=show_width, height=show_height)
@@ -86,7 +179,6 @@ class CaptureArea(tk.Canvas):
         self.RStick = None
         self.calc_time = None
         self.ss = None
-        self.dq = None
         self._langle = None
         self._lmag = None
         self._rangle = None
@@ -99,20 +191,19 @@ class CaptureArea(tk.Canvas):
         # self._logger.addHandler(self.stick_handler)
         # self._logger.propagate = False
         if isTakeLog:
+            # 書き込みは別スレッドで行うので、マウスのイベント処理は待たされない
             filename_base = os.path.join("log", f"{nowtime}")
-            self.LS = logging.FileHandler(filename=f"{filename_base}_LStick.log", encoding='utf-8')
-            self.LS.setLevel(logging.DEBUG)
-            self.LSTICK_logger = logging.getLogger("L_STICK")
-            self.LSTICK_logger.setLevel(logging.DEBUG)
-            self.LSTICK_logger.addHandler(self.LS)
-
-            self.RS = logging.FileHandler(filename=f"{filename_base}_RStick.log", encoding='utf-8')
-            self.RS.setLevel(logging.DEBUG)
-            self.RSTICK_logger = logging.getLogger("R_STICK")
-            self.RSTICK_logger.setLevel(logging.DEBUG)
-            self.RSTICK_logger.addHandler(self.RS)
+            self.l_telemetry = StickTelemetryWriter(f"{filename_base}_LStick.stk")
+            self.r_telemetry = StickTelemetryWriter(f"{filename_base}_RStick.stk")
         # self.circle =
 
+        # プレビューの更新間隔(s)。Tkのイベントループが遅れている間は延ばす
+        self.preview_interval = 1.0 / int(fps)
+        self.max_preview_interval = 0.5
+        self.hidden_interval = 250
+        self._preview_tk = None
+        self._preview_due = None
+        self.renderer = PreviewRenderer(self.camera, self.show_size, self.preview_interval)
         self.setFps(fps)
 
         self.bind("<Control-ButtonPress-1>", self.mouseCtrlLeftPress)
@@ -157,8 +248,8 @@ class CaptureArea(tk.Canvas):
                               outline='red',
                               tag='SelectArea')
 
-        ratio_x = float(self.camera.capture_size[0] / self.show_size[0])
-        ratio_y = float(self.camera.capture_size[1] / self.show_size[1])
+        ratio_x = float(BASE_RESOLUTION[0] / self.show_size[0])
+        ratio_y = float(BASE_RESOLUTION[1] / self.show_size[1])
         print('Mouse down: Show ({}, {}) / Capture ({}, {})'.format(self.min_x, self.min_y,
                                                                     int(self.min_x * ratio_x),
                                                                     int(self.min_y * ratio_y)))
@@ -185,8 +276,8 @@ class CaptureArea(tk.Canvas):
 
     def ReleaseRangeSS(self, event):
         # self.max_x, self.max_y = event.x, event.y
-        ratio_x = float(self.camera.capture_size[0] / self.show_size[0])
-        ratio_y = float(self.camera.capture_size[1] / self.show_size[1])
+        ratio_x = float(BASE_RESOLUTION[0] / self.show_size[0])
+        ratio_y = float(BASE_RESOLUTION[1] / self.show_size[1])
         print('Mouse up: Show ({}, {}) / Capture ({}, {})'.format(self.max_x, self.max_y,
                                                                   int(self.max_x * ratio_x),
                                                                   int(self.max_y * ratio_y)))
@@ -200,8 +291,8 @@ class CaptureArea(tk.Canvas):
 
         self.camera.saveCapture(crop=1,
                                 crop_ax=[
-                                    int(self.min_x * ratio_x), int(self.min_y * ratio_x),
-                                    int(self.max_x * ratio_x), int(self.max_y * ratio_x)])
+                                    int(self.min_x * ratio_x), int(self.min_y * ratio_y),
+                                    int(self.max_x * ratio_x), int(self.max_y * ratio_y)])
 
         t = 0
         self.after(250, self.delete('SelectArea'))
@@ -214,6 +305,8 @@ class CaptureArea(tk.Canvas):
     def setFps(self, fps):
         # self.next_frames = int(16 * (60 / int(fps)))
         self.next_frames = int(1000 / int(fps))
+        self.preview_interval = self.next_frames / 1000
+        self.renderer.interval = self.preview_interval
         self._logger.info(f"FPS set to {fps}")
 
     def setShowsize(self, show_height, show_width):
@@ -221,6 +314,7 @@ class CaptureArea(tk.Canvas):
         self.show_height = int(show_height)
         self.show_size = (self.show_width, self.show_height)
         self.config(width=self.show_width, height=self.show_height)
+        self.renderer.show_size = self.show_size
         print("Show size set to {0} x {1}".format(self.show_width, self.show_height))
         self._logger.info("Show size set to {0} x {1}".format(self.show_width, self.show_height))
 
@@ -229,12 +323,15 @@ class CaptureArea(tk.Canvas):
         if self.master.is_use_left_stick_mouse.get():
             self.UnbindLeftClick()
         x, y = event.x, event.y
-        ratio_x = float(self.camera.capture_size[0] / self.show_size[0])
-        ratio_y = float(self.camera.capture_size[1] / self.show_size[1])
+        ratio_x = float(BASE_RESOLUTION[0] / self.show_size[0])
+        ratio_y = float(BASE_RESOLUTION[1] / self.show_size[1])
         print('Mouse down: Show ({}, {}) / Capture ({}, {})'.format(x, y, int(x * ratio_x), int(y * ratio_y)))
-        print(f"Color [R: {_img[int(y * ratio_y), int(x * ratio_x)][0]}, "
-              f"G: {_img[int(y * ratio_y), int(x * ratio_x)][1]}, "
-              f"B: {_img[int(y * ratio_y), int(x * ratio_x)][2]}]")
+        # 色は実際のキャプチャ解像度の画素から取る
+        px = min(int(x * _img.shape[1] / self.show_size[0]), _img.shape[1] - 1)
+        py = min(int(y * _img.shape[0] / self.show_size[1]), _img.shape[0] - 1)
+        print(f"Color [R: {_img[py, px][0]}, "
+              f"G: {_img[py, px][1]}, "
+              f"B: {_img[py, px][2]}]")
         self._logger.info(
             'Mouse down: Show ({}, {}) / Capture ({}, {})'.format(x, y, int(x * ratio_x), int(y * ratio_y)))
 
@@ -256,16 +353,10 @@ class CaptureArea(tk.Canvas):
         # self.LStick = StickCommand.StickLeft()
         # self.LStick.start(ser)
         if isTakeLog:
-            if self.dq is None:
-                self.dq = deque()
-            else:
-                self.dq.clear()
-
             if self.calc_time is None:
                 self.calc_time = time.perf_counter()
             else:
-                # LSTICK_logger.debug(f"{0},{0},{time.perf_counter() - self.calc_time}")
-                self.dq.append([0, 0, time.perf_counter() - self.calc_time])
+                self.l_telemetry.append(0, 0, time.perf_counter() - self.calc_time)
             self._langle = None
             self._lmag = None
 
@@ -285,25 +376,11 @@ class CaptureArea(tk.Canvas):
                 #                             args=(langle,),
                 #                             kwargs={'r': mag, 'duration': _time - self.calc_time})
                 # thread_1.start()
-                self.ser.writeRow(
-                    f'3 8 '
-                    f'{hex(int(128 + mag * 127.5 * np.cos(np.deg2rad(langle))))} '
-                    f'{hex(int(128 - mag * 127.5 * np.sin(np.deg2rad(langle))))} '
-                    f'80 80',
-                    is_show=False
-                )
-                self.dq.append([langle,
-                                mag,
-                                _time - self.calc_time])
+                self.ser.writeRow(stickRow(left=stickXY(langle, mag), right=(0x80, 0x80)), is_show=False)
+                self.l_telemetry.append(langle, mag, _time - self.calc_time)
                 self.calc_time = _time
         elif not isTakeLog:
-            self.ser.writeRow(
-                f'3 8 '
-                f'{hex(int(128 + mag * 127.5 * np.cos(np.deg2rad(langle))))} '
-                f'{hex(int(128 - mag * 127.5 * np.sin(np.deg2rad(langle))))}'
-                f' 80 80',
-                is_show=False
-            )
+            self.ser.writeRow(stickRow(left=stickXY(langle, mag), right=(0x80, 0x80)), is_show=False)
 
         if mag >= 1:
             center_x = (self.radius + self.radius // 11) * np.cos(np.deg2rad(langle))
@@ -334,11 +411,7 @@ class CaptureArea(tk.Canvas):
             self.BindRightClick()
         # self.event_generate('<Motion>', warp=True, x=self.lx_init, y=self.ly_init)
         if isTakeLog:
-            self.dq.append([self._langle,
-                            self._lmag,
-                            time.perf_counter() - self.calc_time])
-            for _ in self.dq:
-                self.LSTICK_logger.debug(",".join(list(map(str, _))))
+            self.l_telemetry.append(self._langle or 0, self._lmag or 0, time.perf_counter() - self.calc_time)
 
     def mouseRightPress(self, event, ser):
         if self.master.is_use_left_stick_mouse.get():
@@ -355,16 +428,10 @@ class CaptureArea(tk.Canvas):
         # self.RStick = StickCommand.StickRight()
         # self.RStick.start(ser)
         if isTakeLog:
-            if self.dq is None:
-                self.dq = deque()
-            else:
-                self.dq.clear()
-
             if self.calc_time is None:
                 self.calc_time = time.perf_counter()
             else:
-                # LSTICK_logger.debug(f"{0},{0},{time.perf_counter() - self.calc_time}")
-                self.dq.append([0, 0, time.perf_counter() - self.calc_time])
+                self.r_telemetry.append(0, 0, time.perf_counter() - self.calc_time)
         self._rangle = None
         self._rmag = None
 
@@ -383,21 +450,11 @@ class CaptureArea(tk.Canvas):
                 #                             kwargs={'r': mag, 'duration': _time - self.calc_time})
                 # thread_1.start()
                 # self.RStick.RStick(rangle, r=mag)
-                self.ser.writeRow(
-                    f'3 8 80 80 '
-                    f'{hex(int(128 + mag * 127.5 * np.cos(np.deg2rad(rangle))))} '
-                    f'{hex(int(128 - mag * 127.5 * np.sin(np.deg2rad(rangle))))}',
-                    is_show=False
-                )
-                self.dq.append([rangle, mag, _time - self.calc_time])
+                self.ser.writeRow(stickRow(left=(0x80, 0x80), right=stickXY(rangle, mag)), is_show=False)
+                self.r_telemetry.append(rangle, mag, _time - self.calc_time)
                 self.calc_time = _time
         elif not isTakeLog:
-            self.ser.writeRow(
-                f'3 8 80 80 '
-                f'{hex(int(128 + mag * 127.5 * np.cos(np.deg2rad(rangle))))} '
-                f'{hex(int(128 - mag * 127.5 * np.sin(np.deg2rad(rangle))))}',
-                is_show=False
-            )
+            self.ser.writeRow(stickRow(left=(0x80, 0x80), right=stickXY(rangle, mag)), is_show=False)
         if mag >= 1:
             center_x = (self.radius + self.radius // 11) * np.cos(np.deg2rad(rangle))
             center_y = (self.radius + self.radius // 11) * np.sin(np.deg2rad(rangle))
@@ -428,44 +485,61 @@ class CaptureArea(tk.Canvas):
 
         # self.event_generate('<Motion>', warp=True, x=self.rx_init, y=self.ry_init)
         if isTakeLog:
-            self.dq.append([self._rangle,
-                            self._rmag,
-                            time.perf_counter() - self.calc_time])
-            for _ in self.dq:
-                self.RSTICK_logger.debug(",".join(list(map(str, _))))
+            self.r_telemetry.append(self._rangle or 0, self._rmag or 0, time.perf_counter() - self.calc_time)
 
     def startCapture(self):
+        self.renderer.start()
         self.capture()
 
+    def destroy(self):
+        self.renderer.stop()
+        super().destroy()
+
     def capture(self):
-        if self.is_show_var.get():
-            image_bgr = self.camera.readFrame()
-        else:
-            self.after(self.next_frames, self.capture)
+        # 非表示・最小化の間は画像を作らない
+        if not self.is_show_var.get() or not self.winfo_viewable():
+            self.renderer.setPaused(True)
+            self._preview_due = None
+            self.after(self.hidden_interval, self.capture)
             return
+        self.renderer.setPaused(False)
 
-        if image_bgr is not None:
-            image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-            image_pil = Image.fromarray(image_rgb).resize(self.show_size)
-            image_tk = ImageTk.PhotoImage(image_pil)
-
-            self.im = image_tk
-            # self.configure( image=image_tk)
-            self.itemconfig(self.im_, image=image_tk)
-        else:
+        start = time.perf_counter()
+        is_new, image = self.renderer.take()
+        if is_new and image is not None:
+            if self._preview_tk is None or (self._preview_tk.width(), self._preview_tk.height()) != image.size:
+                self._preview_tk = ImageTk.PhotoImage(image)
+            else:
+                self._preview_tk.paste(image)
+            if self.im is not self._preview_tk:
+                self.im = self._preview_tk
+                self.itemconfig(self.im_, image=self._preview_tk)
+        elif is_new:
             self.im = self.disabled_tk
             # self.configure(image=self.disabled_tk)
             self.itemconfig(self.im_, image=self.disabled_tk)
 
-        self.after(self.next_frames, self.capture)
+        self.adaptPreviewInterval(start, time.perf_counter() - start)
+        self._preview_due = time.perf_counter() + self.preview_interval
+        self.after(int(self.preview_interval * 1000), self.capture)
+
+    def adaptPreviewInterval(self, now, cost):
+        # 予定より遅れて呼ばれたか、貼り替えに時間がかかった場合は間隔を延ばし、余裕があれば設定値に戻す
+        target = self.next_frames / 1000
+        lag = now - self._preview_due if self._preview_due is not None else 0.0
+        if lag + cost > self.preview_interval * 0.5:
+            self.preview_interval = min(self.max_preview_interval, self.preview_interval * 1.5)
+        elif self.preview_interval > target:
+            self.preview_interval = max(target, self.preview_interval * 0.9)
+        self.renderer.interval = self.preview_interval
 
     def saveCapture(self):
         self.camera.saveCapture()
 
     def ImgRect(self, x1, y1, x2, y2, outline, tag, ms):
 
-        ratio_x = float(self.show_size[0] / self.camera.capture_size[0])
-        ratio_y = float(self.show_size[1] / self.camera.capture_size[1])
+        ratio_x = float(self.show_size[0] / BASE_RESOLUTION[0])
+        ratio_y = float(self.show_size[1] / BASE_RESOLUTION[1])
         self.create_rectangle((x1 - 1.0) * ratio_x, (y1 - 1.0) * ratio_y, (x2 + 1.0) * ratio_x, (y2 + 1.0) * ratio_y,
                               width=4.5,
                               outline="white", tag=tag)
@@ -4,6 +4,7 @@ import tkinter as tk
 from KeyConfig import PokeKeycon
 from LineNotify import Line_Notify
 from get_pokestatistics import GetFromHomeGUI
+from Commands.Trace import defaultTracePath
 from logging import getLogger, DEBUG, NullHandler
 
 
@@ -49,6 +50,8 @@ class PokeController_Menubar(tk.Menu):
         self.menu_command.add('command', command=self.OpenPokeHomeCoop, label='Pokemon Home 連携')
         self.menu_command.add('command', command=self.OpenKeyConfig, label='キーコンフィグ')
         self.menu_command.add('command', command=self.ResetWindowSize, label='画面サイズのリセット')
+        self.menu_command.add('command', command=self.ToggleTraceRecording, label='入力の記録を開始')
+        self.trace_menu_index = self.menu_command.index('end')
 
     # TODO: setup command_id_arg 'false' for menuitem.
 
@@ -90,6 +93,17 @@ class PokeController_Menubar(tk.Menu):
         self.key_config.destroy()
         self.key_config = None
 
+    def ToggleTraceRecording(self):
+        # 送った入力を記録する(コマンド「記録したログを再生」で再生できる)
+        if self.ser.isRecording():
+            self.ser.stopRecording()
+            self.menu_command.entryconfigure(self.trace_menu_index, label='入力の記録を開始')
+        else:
+            path = defaultTracePath()
+            self.ser.startRecording(path)
+            print(f'Recording inputs to {path}')
+            self.menu_command.entryconfigure(self.trace_menu_index, label='入力の記録を停止')
+
     def ResetWindowSize(self):
         self._logger.debug("Reset window size")
         self.preview.setShowsize(360, 640)
@@ -97,6 +111,7 @@ class PokeController_Menubar(tk.Menu):
 
     def exit(self):
         self._logger.debug("Close Menubar")
+        self.ser.stopRecording()
         if self.ser.isOpened():
             self.ser.closeSerial()
             print("serial disconnected")
@@ -109,6 +124,7 @@ class PokeController_Menubar(tk.Menu):
         # save settings
         self.settings.save()
 
+        self.preview.renderer.stop()
         self.camera.destroy()
         cv2.destroyAllWindows()
         self.master.destroy()
@@ -37,6 +37,16 @@ class GuiSettings:
         self.is_show_realtime = tk.BooleanVar(value=self.setting['General Setting'].getboolean('is_show_realtime'))
         self.is_show_serial = tk.BooleanVar(value=self.setting['General Setting'].getboolean('is_show_serial'))
         self.is_use_keyboard = tk.BooleanVar(value=self.setting['General Setting'].getboolean('is_use_keyboard'))
+        self.use_capture_thread = tk.BooleanVar(
+            value=self.setting['General Setting'].getboolean('use_capture_thread', fallback=True))
+        self.use_binary_protocol = tk.BooleanVar(
+            value=self.setting['General Setting'].getboolean('use_binary_protocol', fallback=False))
+        # ファームウェアが対応していれば、press()の押している時間をファームウェアに数えさせる
+        self.use_mcu_hold = tk.BooleanVar(
+            value=self.setting['General Setting'].getboolean('use_mcu_hold', fallback=False))
+        # キャプチャ解像度(例: 640x360)。テンプレートは解像度に合わせて拡大・縮小される
+        self.capture_size = tk.StringVar(
+            value=self.setting['General Setting'].get('capture_size', fallback='1280x720'))
         # Pokemon Home用の設定
         self.season = tk.StringVar(value=self.setting['Pokemon Home'].get('Season'))
         self.is_SingleBattle = tk.StringVar(value=self.setting['Pokemon Home'].get('Single or Double'))
@@ -58,6 +68,10 @@ class GuiSettings:
             'is_show_realtime': True,
             'is_show_serial': False,
             'is_use_keyboard': True,
+            'use_capture_thread': True,
+            'use_binary_protocol': False,
+            'use_mcu_hold': False,
+            'capture_size': '1280x720',
         }
         # pokemon home用の設定
         self.setting['Pokemon Home'] = {
@@ -118,6 +132,10 @@ class GuiSettings:
             'is_show_realtime': self.is_show_realtime.get(),
             'is_show_serial': self.is_show_serial.get(),
             'is_use_keyboard': self.is_use_keyboard.get(),
+            'use_capture_thread': self.use_capture_thread.get(),
+            'use_binary_protocol': self.use_binary_protocol.get(),
+            'use_mcu_hold': self.use_mcu_hold.get(),
+            'capture_size': self.capture_size.get(),
         }
         # pokemon home用の設定
         self.setting['Pokemon Home'] = {
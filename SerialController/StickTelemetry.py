@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import struct
+import threading
+from logging import getLogger, DEBUG, NullHandler
+
+import numpy as np
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
+STICK_MAGIC = b'PCSTICK1'
+COLUMNS = ('angle', 'magnitude', 'duration')
+# バッチごとのサンプル数。続けて列ごとにfloat32(リトルエンディアン)の配列を並べる
+BATCH = struct.Struct('<I')
+
+
+class StickTelemetryWriter:
+    """
+    マウス操作のスティック入力(角度、倒す量、継続時間)をファイルに書き出すクラス
+
+    `append`はリストに追加するだけで、ファイルへの書き込みは専用のスレッドが行う。
+    `batch_size`個たまるか`flush_interval`秒経つと、新しいサンプルだけを列ごとの配列にまとめて追記する。
+
+    Args:
+        path (str): 書き出すファイルのパス
+    """
+
+    def __init__(self, path, batch_size=256, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.count = 0
+
+        self._samples = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._file = open(path, 'wb')
+        self._file.write(STICK_MAGIC)
+        self._thread = threading.Thread(target=self._run, name="StickTelemetry", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, angle, magnitude, duration):
+        with self._lock:
+            self._samples.append((angle, magnitude, duration))
+            if len(self._samples) >= self.batch_size:
+                self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            stop = self._stop
+            self._flush()
+            if stop:
+                break
+
+    def _flush(self):
+        with self._lock:
+            samples, self._samples = self._samples, []
+        if not samples:
+            return
+        columns = np.array(samples, dtype='<f4').T
+        try:
+            self._file.write(BATCH.pack(len(samples)))
+            self._file.write(np.ascontiguousarray(columns).tobytes())
+            self._file.flush()
+            self.count += len(samples)
+        except OSError as e:
+            logger.error(f"Failed to write stick telemetry: {e}")
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._stop = True
+        self._wakeup.set()
+        self._thread.join()
+        self._file.close()
+        atexit.unregister(self.close)
+        logger.debug(f"Wrote {self.count} stick samples: {self.path}")
+
+
+def readStickTelemetry(path):
+    """
+    StickTelemetryWriterで書き出したファイルを、バッチごとに読みながら1サンプルずつ返す
+
+    Yields:
+        tuple: (angle, magnitude, duration)
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(STICK_MAGIC)) != STICK_MAGIC:
+            raise ValueError(f"Not a stick telemetry file: {path}")
+        while True:
+            head = file.read(BATCH.size)
+            if len(head) < BATCH.size:
+                return
+            n, = BATCH.unpack(head)
+            data = file.read(n * len(COLUMNS) * 4)
+            if len(data) < n * len(COLUMNS) * 4:
+                # 書きかけのバッチは無視する
+                return
+            columns = np.frombuffer(data, dtype='<f4').reshape(len(COLUMNS), n)
+            yield from zip(*(column.tolist() for column in columns))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import configparser
+import os
+import threading
+from collections import OrderedDict
+from logging import getLogger, DEBUG, NullHandler
+
+import cv2
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
+TEMPLATE_DIR = "Template"
+RESOLUTION_PATH = os.path.join(TEMPLATE_DIR, "resolution.ini")
+# テンプレートを切り出したキャプチャの解像度(resolution.iniに記述がない場合)
+DEFAULT_RESOLUTION = (1280, 720)
+
+
+class TemplateCache:
+    """
+    テンプレート画像のプロセス共通キャッシュ
+
+    解決済みパス・グレースケール/カラーの別・解像度をキーとし、ファイルの更新時刻が変わった場合は読み直す。
+    合計サイズが`max_bytes`を超えると、最も長く使われていないものから破棄する(LRU)。
+    キャッシュした画像は共有されるため、書き込み不可にして返す。
+
+    テンプレートを切り出したキャプチャの解像度は`Template/resolution.ini`に記述する(既定は1280x720)。
+
+        [DEFAULT]
+        resolution = 1280, 720
+        [Pokemon/status_1080p.png]
+        resolution = 1920, 1080
+
+    `size`に現在のキャプチャ解像度を渡すと、その解像度に合わせて拡大・縮小したテンプレートを返す。
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, resolution_path=RESOLUTION_PATH):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (resolved path, use_gray, size) -> (mtime, image)
+
+        self.resolution_path = resolution_path
+        self._resolutions = configparser.ConfigParser()
+        if os.path.isfile(resolution_path):
+            self._resolutions.read(resolution_path, encoding='utf-8')
+            logger.debug(f"Loaded template resolutions: {resolution_path}")
+
+    def nativeResolution(self, template_path):
+        """
+        Returns:
+            tuple: テンプレートを切り出したキャプチャの解像度 (width, height)
+        """
+        name = os.path.relpath(os.path.realpath(template_path), os.path.realpath(TEMPLATE_DIR)).replace(os.sep, '/')
+        section = self._resolutions[name] if self._resolutions.has_section(name) else self._resolutions.defaults()
+        value = section.get('resolution')
+        if not value:
+            return DEFAULT_RESOLUTION
+        w, h = (int(v) for v in value.split(','))
+        return w, h
+
+    def get(self, template_path, use_gray=True, size=None):
+        """
+        Args:
+            size (tuple): 現在のキャプチャ解像度 (width, height)。Noneの場合は切り出したときの大きさのまま返す
+        """
+        resolved = os.path.realpath(template_path)
+        try:
+            mtime = os.stat(resolved).st_mtime_ns
+        except OSError:
+            logger.error(f"Template not found: {template_path}")
+            return None
+
+        native = self.nativeResolution(resolved)
+        if size is None or tuple(size) == native:
+            return self._load((resolved, bool(use_gray), native), mtime, lambda: self._read(resolved, use_gray))
+
+        def scale():
+            image = self.get(resolved, use_gray)
+            if image is None:
+                return None
+            fx, fy = size[0] / native[0], size[1] / native[1]
+            w = max(1, round(image.shape[1] * fx))
+            h = max(1, round(image.shape[0] * fy))
+            # 縮小はINTER_AREA、拡大はINTER_LINEARで行う
+            return cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA if fx * fy < 1 else cv2.INTER_LINEAR)
+
+        return self._load((resolved, bool(use_gray), tuple(size)), mtime, scale)
+
+    @staticmethod
+    def _read(resolved, use_gray):
+        image = cv2.imread(resolved, cv2.IMREAD_GRAYSCALE if use_gray else cv2.IMREAD_COLOR)
+        if image is None:
+            logger.error(f"Failed to load template: {resolved}")
+        return image
+
+    def _load(self, key, mtime, make):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        # デコード・拡大縮小はロックの外で行う
+        image = make()
+        if image is None:
+            return None
+        image.flags.writeable = False
+
+        with self._lock:
+            self.misses += 1
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.cur_bytes -= old[1].nbytes
+            self._cache[key] = (mtime, image)
+            self.cur_bytes += image.nbytes
+            self._evict()
+        return image
+
+    def preload(self, template_paths, use_gray=True, size=None):
+        return [self.get(template_path, use_gray, size) for template_path in template_paths]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.cur_bytes = 0
+
+    def _evict(self):
+        # 直前に追加したものは残す
+        while self.cur_bytes > self.max_bytes and len(self._cache) > 1:
+            _, (_, image) = self._cache.popitem(last=False)
+            self.cur_bytes -= image.nbytes
+            logger.debug(f"Evicted a template from cache ({self.cur_bytes} bytes in use)")
+
+
+template_cache = TemplateCache()
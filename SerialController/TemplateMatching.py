@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger, DEBUG, NullHandler
+
+import cv2
+import numpy as np
+
+from TemplateCache import template_cache
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _getExecutor():
+    # OpenCVはmatchTemplate中にGILを解放するので、スレッドで並列に実行できる
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2,
+                                           thread_name_prefix="TemplateMatch")
+        return _executor
+
+
+def matchTemplate(src, template, method=cv2.TM_CCOEFF_NORMED):
+    res = cv2.matchTemplate(src, template, method)
+    _, max_val, _, max_loc = cv2.minMaxLoc(res)
+    return max_val, max_loc
+
+
+def _findPeaks(res, num_peaks, suppress_w, suppress_h):
+    # 相関マップから上位の候補点を取り出す(周辺を潰しながら順に探す)
+    res = res.copy()
+    peaks = []
+    for _ in range(num_peaks):
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        if max_val <= -1.0:
+            break
+        peaks.append(max_loc)
+        x, y = max_loc
+        res[max(0, y - suppress_h): y + suppress_h + 1, max(0, x - suppress_w): x + suppress_w + 1] = -1.0
+    return peaks
+
+
+def matchTemplatePyramid(src, template, levels=2, threshold=0.7, fallback_margin=0.05, num_candidates=3,
+                         min_template_size=8, get_small_src=None):
+    """
+    縮小画像で候補位置を探し、候補の周辺だけを等倍で再探索するテンプレートマッチング
+
+    等倍での最大相関値が閾値から`fallback_margin`以内の場合は、判定を誤らないよう全体を等倍で探索し直す。
+    縮小後のテンプレートが`min_template_size`より小さくなる場合も等倍で探索する。
+
+    Args:
+        levels (int): ピラミッドの段数(1段ごとに1/2に縮小)
+        get_small_src (callable): 縮小済みの`src`を返す関数(Camera.Frameのキャッシュを使う場合)
+
+    Returns:
+        tuple: (max_val, max_loc)
+    """
+    scale = 2 ** levels
+    th, tw = template.shape[:2]
+    if levels <= 0 or tw // scale < min_template_size or th // scale < min_template_size:
+        return matchTemplate(src, template)
+
+    sh, sw = src.shape[:2]
+    if get_small_src is not None:
+        small_src = get_small_src()
+    else:
+        small_src = cv2.resize(src, (sw // scale, sh // scale), interpolation=cv2.INTER_AREA)
+    small_template = cv2.resize(template, (tw // scale, th // scale), interpolation=cv2.INTER_AREA)
+    res = cv2.matchTemplate(small_src, small_template, cv2.TM_CCOEFF_NORMED)
+    peaks = _findPeaks(res, num_candidates, small_template.shape[1] // 2, small_template.shape[0] // 2)
+
+    best_val, best_loc = -1.0, (0, 0)
+    margin = scale * 2
+    for px, py in peaks:
+        x1 = max(0, px * scale - margin)
+        y1 = max(0, py * scale - margin)
+        x2 = min(sw, px * scale + tw + margin)
+        y2 = min(sh, py * scale + th + margin)
+        if x2 - x1 < tw or y2 - y1 < th:
+            continue
+        max_val, max_loc = matchTemplate(src[y1:y2, x1:x2], template)
+        if max_val > best_val:
+            best_val, best_loc = max_val, (max_loc[0] + x1, max_loc[1] + y1)
+
+    if abs(best_val - threshold) <= fallback_margin:
+        logger.debug(f"Pyramid result {best_val:.3f} is close to the threshold. Fall back to a full search")
+        return matchTemplate(src, template)
+    return best_val, best_loc
+
+
+def nonMaxSuppression(boxes, scores, overlap=0.3):
+    """
+    重なりが`overlap`(IoU)を超える枠のうち、相関値の低いものを取り除く
+
+    Args:
+        boxes (np.ndarray): shape (N, 4) の [x1, y1, x2, y2]
+        scores (np.ndarray): shape (N,) の相関値
+
+    Returns:
+        np.ndarray: 残した枠のインデックス(相関値の高い順)
+    """
+    x1, y1, x2, y2 = (boxes[:, i].astype(np.float64) for i in range(4))
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter)
+        order = rest[iou <= overlap]
+    return np.array(keep, dtype=np.intp)
+
+
+def findAllTemplates(src, template, threshold=0.8, nms_overlap=0.3, max_candidates=1000):
+    """
+    1回のmatchTemplateで、閾値以上の位置を全て取り出す
+
+    相関マップの極大点を閾値で絞り、重なった候補をNMSでまとめる。ボックスのアイコンのように
+    同じ画像が並んでいる画面を、1フレームでまとめて調べるために使う。
+
+    Args:
+        nms_overlap (float): 同じ物とみなす重なり(IoU)
+        max_candidates (int): NMSにかける候補の最大数(相関値の高い順)
+
+    Returns:
+        tuple: (boxes, scores) shape (N, 4) の [x1, y1, x2, y2] と shape (N,) の相関値。相関値の高い順
+    """
+    th, tw = template.shape[:2]
+    res = cv2.matchTemplate(src, template, cv2.TM_CCOEFF_NORMED)
+    # 近傍で最大の点だけを候補にする
+    peaks = (res >= threshold) & (res >= cv2.dilate(res, np.ones((3, 3), np.uint8)))
+    ys, xs = np.nonzero(peaks)
+    scores = res[ys, xs]
+    if scores.size > max_candidates:
+        top = np.argpartition(scores, -max_candidates)[-max_candidates:]
+        ys, xs, scores = ys[top], xs[top], scores[top]
+
+    boxes = np.stack([xs, ys, xs + tw, ys + th], axis=1).astype(np.int32)
+    keep = nonMaxSuppression(boxes, scores, nms_overlap)
+    return boxes[keep].reshape(-1, 4), scores[keep]
+
+
+def fitCrop(crop, template_size, frame_size):
+    """
+    切り出し範囲がテンプレートより小さい場合(matchTemplateが失敗する)は、中心を保ったままテンプレートの大きさまで広げる
+
+    Args:
+        crop (list): [x1, y1, x2, y2]
+        template_size (tuple): テンプレートの (w, h)
+        frame_size (tuple): フレームの (w, h)
+
+    Returns:
+        list: 広げた切り出し範囲。フレームに収まらない場合は全体を探索する空のリスト
+    """
+    if len(crop) != 4:
+        return crop
+    (tw, th), (fw, fh) = template_size, frame_size
+    if tw > fw or th > fh:
+        return []
+    x1, y1, x2, y2 = crop
+    if x2 - x1 < tw:
+        x1 = min(max(0, (x1 + x2 - tw) // 2), fw - tw)
+        x2 = x1 + tw
+    if y2 - y1 < th:
+        y1 = min(max(0, (y1 + y2 - th) // 2), fh - th)
+        y2 = y1 + th
+    return [x1, y1, x2, y2]
+
+
+def prepareSource(src, use_gray=True, crop=()):
+    src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY) if use_gray and src.ndim == 3 else src
+    if len(crop) == 4:
+        src = src[crop[1]: crop[3], crop[0]: crop[2]]
+    return src
+
+
+class TemplateSet:
+    """
+    複数のテンプレートをまとめて扱うクラス
+
+    1フレームにつきグレースケール化と切り出しを1回だけ行い、各テンプレートのマッチングをスレッドプールで並列に実行する。
+    結果は各テンプレートの相関値と位置をNumPy配列で返す。
+
+    Args:
+        template_paths (list): テンプレート画像のパス(解決済み)
+        use_gray (bool): グレースケールでマッチングするか
+    """
+
+    def __init__(self, template_paths, use_gray=True):
+        self.template_paths = list(template_paths)
+        self.use_gray = use_gray
+
+    def __len__(self):
+        return len(self.template_paths)
+
+    def loadTemplates(self, size=None):
+        templates = template_cache.preload(self.template_paths, self.use_gray, size)
+        for template_path, template in zip(self.template_paths, templates):
+            if template is None:
+                raise FileNotFoundError(f"Template cannot be loaded: {template_path}")
+        return templates
+
+    def sizes(self, size=None):
+        """
+        Args:
+            size (tuple): キャプチャ解像度 (width, height)。Noneの場合は切り出したときの大きさ
+
+        Returns:
+            np.ndarray: shape (N, 2) の各テンプレートの (w, h)
+        """
+        return np.array([(t.shape[1], t.shape[0]) for t in self.loadTemplates(size)], dtype=np.int32)
+
+    def match(self, src, crop=(), is_prepared=False, size=None):
+        """
+        Args:
+            src (np.ndarray): BGRのフレーム(`is_prepared`がTrueの場合は前処理済みの画像)
+            crop (list): [x1, y1, x2, y2] の切り出し範囲
+            size (tuple): フレームの解像度 (width, height)。テンプレートをこの解像度に合わせて拡大・縮小する
+
+        Returns:
+            tuple: (scores, locs) shape (N,) の相関値と shape (N, 2) の左上座標 (x, y)
+        """
+        if not is_prepared:
+            src = prepareSource(src, self.use_gray, crop)
+        templates = self.loadTemplates(size)
+
+        if len(templates) > 1:
+            results = list(_getExecutor().map(lambda t: matchTemplate(src, t), templates))
+        else:
+            results = [matchTemplate(src, t) for t in templates]
+
+        scores = np.fromiter((r[0] for r in results), dtype=np.float64, count=len(results))
+        locs = np.array([r[1] for r in results], dtype=np.int32).reshape(-1, 2)
+        return scores, locs
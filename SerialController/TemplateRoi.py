@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import configparser
+import os
+import threading
+import time
+from logging import getLogger, DEBUG, NullHandler
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+logger.setLevel(DEBUG)
+logger.propagate = True
+
+ROI_PATH = os.path.join("Template", "roi.ini")
+
+
+class TemplateRoiRegistry:
+    """
+    テンプレートごとの探索範囲(ROI)を管理するクラス
+
+    `Template/roi.ini`にテンプレート名のセクションを作り、以下の値を記述する。
+
+        [egg_notice.png]
+        # 手動で指定する探索範囲 x1, y1, x2, y2
+        region = 0, 520, 1280, 720
+        # 探索範囲の余白(省略時は既定値)
+        margin = 16
+
+    学習モードでは実際にマッチした位置を`observed`に記録し、`hits`回以上観測された後は
+    `region`より観測範囲を優先して探索範囲を狭めていく。
+    """
+
+    def __init__(self, path=ROI_PATH, margin=16, min_hits=3, save_interval=10.0):
+        self.path = path
+        self.margin = margin
+        self.min_hits = min_hits
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self.config = configparser.ConfigParser()
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.path):
+            self.config.read(self.path, encoding='utf-8')
+            logger.debug(f"Loaded ROI registry: {self.path}")
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                with open(self.path, 'w', encoding='utf-8') as file:
+                    self.config.write(file)
+                self._dirty = False
+                self._last_save = time.monotonic()
+                logger.debug(f"Saved ROI registry: {self.path}")
+            except OSError as e:
+                logger.error(f"Failed to save ROI registry: {e}")
+
+    @staticmethod
+    def _parseRect(value):
+        return [int(v) for v in value.split(',')]
+
+    def getRegion(self, template_name):
+        """
+        Returns:
+            list: 余白を含まない探索範囲 [x1, y1, x2, y2]。登録がない場合は空のリスト
+        """
+        with self._lock:
+            if not self.config.has_section(template_name):
+                return []
+            section = self.config[template_name]
+            if 'observed' in section and section.getint('hits', 0) >= self.min_hits:
+                return self._parseRect(section['observed'])
+            if 'region' in section:
+                return self._parseRect(section['region'])
+            return []
+
+    def getCrop(self, template_name, frame_shape):
+        """
+        余白を加え、フレームの範囲に収めた探索範囲を返す。
+
+        Args:
+            template_name (str): テンプレート名
+            frame_shape (tuple): フレームの shape
+
+        Returns:
+            list: [x1, y1, x2, y2]。登録がない場合は空のリスト
+        """
+        region = self.getRegion(template_name)
+        if not region:
+            return []
+        with self._lock:
+            margin = self.config[template_name].getint('margin', self.margin)
+        h, w = frame_shape[:2]
+        return [max(0, region[0] - margin), max(0, region[1] - margin),
+                min(w, region[2] + margin), min(h, region[3] + margin)]
+
+    def learn(self, template_name, top_left, w, h):
+        # マッチした範囲を観測範囲に加える
+        x1, y1 = int(top_left[0]), int(top_left[1])
+        x2, y2 = x1 + int(w), y1 + int(h)
+        with self._lock:
+            if not self.config.has_section(template_name):
+                self.config.add_section(template_name)
+            section = self.config[template_name]
+            if 'observed' in section:
+                ox1, oy1, ox2, oy2 = self._parseRect(section['observed'])
+                x1, y1, x2, y2 = min(x1, ox1), min(y1, oy1), max(x2, ox2), max(y2, oy2)
+            section['observed'] = f"{x1}, {y1}, {x2}, {y2}"
+            section['hits'] = str(section.getint('hits', 0) + 1)
+            self._dirty = True
+            is_save = time.monotonic() - self._last_save > self.save_interval
+        if is_save:
+            self.save()
+
+
+roi_registry = TemplateRoiRegistry()
@@ -150,7 +150,7 @@ class PokeControllerApp:
 
         self.baud_rate_cb = ttk.Combobox(self.serial_lf)
         self.baud_rate = tk.StringVar()
-        self.baud_rate_cb.config(justify='right', state='readonly', textvariable=self.baud_rate, values=[9600, 4800])
+        self.baud_rate_cb.config(justify='right', state='readonly', textvariable=self.baud_rate, values=[9600, 4800, 115200, 250000])
         self.baud_rate_cb.config(width='6')
         self.baud_rate_cb.grid(column='3', padx='5', row='0', sticky='ew')
         self.baud_rate_cb.bind('<<ComboboxSelected>>', self.applyBaudRate, add='')
@@ -312,10 +312,12 @@ class PokeControllerApp:
             self.camera_name_fromDLL.set("Unknown environment. Cannot show Camera name.")
             self.Camera_Name.config(state='disable')
         # open up a camera
-        self.camera = Camera(self.fps.get())
+        self.camera = Camera(self.fps.get(), self.settings.use_capture_thread.get(),
+                             capture_size=tuple(map(int, self.settings.capture_size.get().split("x"))))
         self.openCamera()
         # activate serial communication
-        self.ser = Sender.Sender(self.is_show_serial)
+        self.ser = Sender.Sender(self.is_show_serial, use_binary=self.settings.use_binary_protocol.get(),
+                                 use_hold=self.settings.use_mcu_hold.get())
         self.activateSerial()
         self.activateKeyboard()
         self.preview = CaptureArea(self.camera,
@@ -349,7 +351,13 @@ class PokeControllerApp:
         # logging.debug(f'python version: {sys.version}')
 
     def openCamera(self):
+        # 開き直している間は、プレビューを作るスレッドを止めておく
+        preview = getattr(self, 'preview', None)
+        if preview is not None:
+            preview.renderer.stop()
         self.camera.openCamera(self.camera_id.get())
+        if preview is not None:
+            preview.renderer.start()
 
     def assignCamera(self, event):
         if platform.system() != "Linux":
@@ -623,6 +631,7 @@ class PokeControllerApp:
     def exit(self):
         ret = tkmsg.askyesno('確認', 'Poke Controllerを終了しますか？')
         if ret:
+            self.ser.stopRecording()
             if self.ser.isOpened():
                 self.ser.closeSerial()
                 print("Serial disconnected")
@@ -645,6 +654,7 @@ class PokeControllerApp:
 
             self.settings.save()
 
+            self.preview.renderer.stop()
             self.camera.destroy()
             cv2.destroyAllWindows()
             self._logger.debug("Stop Poke Controller")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# スティック入力の行を作る処理の速さを比べるスクリプト
+# python benchmark_encoding.py
+
+import math
+import random
+import timeit
+
+import numpy as np
+
+from Commands.Keys import Direction, SendFormat, Stick, stickRow, stickXY
+
+
+def legacyStickRow(angle, r):
+    # 以前のGuiAssets/StickCommandの書き方
+    return (f'3 8 {hex(int(128 + r * 127.5 * np.cos(np.deg2rad(angle))))} '
+            f'{hex(int(128 - r * 127.5 * np.sin(np.deg2rad(angle))))} 80 80')
+
+
+def legacyConvert2str(fmt, L_stick_changed, R_stick_changed):
+    # 以前のSendFormat.convert2str
+    space = ' '
+    str_L = ''
+    str_R = ''
+    send_btn = int(fmt['btn']) << 2
+    if L_stick_changed:
+        send_btn |= 0x2
+        str_L = format(fmt['lx'], 'x') + space + format(fmt['ly'], 'x')
+    if R_stick_changed:
+        send_btn |= 0x1
+        str_R = format(fmt['rx'], 'x') + space + format(fmt['ry'], 'x')
+    str_Hat = str(int(fmt['hat']))
+    return format(send_btn, '#06x') + \
+        (space + str_Hat) + \
+        (space + str_L if L_stick_changed else '') + \
+        (space + str_R if R_stick_changed else '')
+
+
+def legacyDirection(angle, mag):
+    angle = math.radians(angle)
+    return math.ceil(127.5 * math.cos(angle) * mag + 127.5), math.floor(127.5 * math.sin(angle) * mag + 127.5)
+
+
+def report(name, before, after, n):
+    print(f"{name:<12} before {n / before:>12,.0f} rows/s   after {n / after:>12,.0f} rows/s   x{before / after:.1f}")
+
+
+def main(n=100000):
+    random.seed(0)
+    samples = [(random.uniform(-180, 180), random.random()) for _ in range(n)]
+    degrees = [(random.randrange(3600) / 10, random.random()) for _ in range(n)]
+
+    # 変換後の値が変わらないことを確認する
+    fmt = SendFormat()
+    for angle, mag in degrees[:1000]:
+        d = Direction(Stick.LEFT, angle, mag)
+        assert (d.x, d.y) == legacyDirection(angle, mag)
+        fmt.setAnyDirection([d])
+        fmt.R_stick_changed = True
+        expected = legacyConvert2str(fmt.format, fmt.L_stick_changed, fmt.R_stick_changed)
+        assert fmt.convert2str() == expected
+
+    before = timeit.timeit(lambda: [legacyStickRow(a, r) for a, r in samples], number=1)
+    after = timeit.timeit(lambda: [stickRow(left=stickXY(a, r), right=(0x80, 0x80)) for a, r in samples], number=1)
+    report('stick row', before, after, n)
+
+    def legacyConvertAll():
+        state = fmt.format
+        for angle, mag in degrees:
+            state['lx'], state['ly'] = int(angle) % 256, int(mag * 255)
+            legacyConvert2str(state, True, False)
+
+    def convertAll():
+        for angle, mag in degrees:
+            fmt.lx, fmt.ly = int(angle) % 256, int(mag * 255)
+            fmt.L_stick_changed = True
+            fmt.convert2str()
+
+    before = timeit.timeit(legacyConvertAll, number=1)
+    after = timeit.timeit(convertAll, number=1)
+    report('convert2str', before, after, n)
+
+
+if __name__ == "__main__":
+    main()